@@ -1,6 +1,14 @@
 import boto3
+import bisect
+import codecs
 import csv
 import botocore
+import botocore.config
+import itertools
+import threading
+import time
+from array import array
+from concurrent.futures import ThreadPoolExecutor
 from time import gmtime, strftime
 from boto3.session import Session
 import json
@@ -16,15 +24,65 @@ SageMakerRole = os.environ['SageMakerExecutionRole']
 #use json to send data to model and get back the prediction.
 JSON_CONTENT_TYPE = "text/csv"
 
+#Rows are sent to the endpoint in batches of BatchRows rows (see UserParameters), as multi-line CSV payloads that are
+#kept under the 6 MB request limit of InvokeEndpoint
+DEFAULT_BATCH_ROWS = 1000
+MAX_PAYLOAD_BYTES = 5 * 1024 * 1024
+
+#Bytes of the validation data read from S3 at a time
+STREAM_CHUNK_BYTES = 64 * 1024
+
+#PostProcessing - Because we chose binary:logistic as our objective metric, our result for the payload will be
+# an output probability. We use the optimal cutoff detailed in the example notebook by default; it is configurable
+# with Cutoff in the UserParameters based on post-processing evaluation of impact, and the threshold sweep in the
+# evaluation shows the metrics at other cutoffs.
+DEFAULT_CUTOFF = 0.46
+SWEEP_THRESHOLDS = [round(0.05 * i, 2) for i in range(1, 20)]
+
+#Metrics that the MinMetrics UserParameter can set a minimum for
+GATED_METRICS = ('accuracy', 'precision', 'recall', 'f1', 'auc')
+
+#Load profile - with LoadProfile in the UserParameters, the endpoint is also put under load for Seconds per step, at
+#every concurrency of a ramp and for every payload size, using rows of the validation data. The latency and
+#throughput are compared to the baseline recorded by the last model that passed the stage in the same environment,
+#which the new model replaces if it passes. Settings left out of LoadProfile take these defaults.
+DEFAULT_LOAD_PROFILE = {
+    'Concurrency': [1, 2, 4, 8],
+    'PayloadRows': [1, 100],
+    'Seconds': 10,
+    # Steps with more errors than this do not count towards the sustainable throughput
+    'MaxErrorRate': 0.01,
+    # How much slower (p50 and p95 latency) and how much less throughput than the baseline is tolerated
+    'MaxLatencyRegression': 0.2,
+    'MaxThroughputRegression': 0.2,
+}
+#The steps have to leave time for the evaluation within the 15 minute Lambda timeout
+MAX_LOAD_PROFILE_SECONDS = 600
+LOAD_PROFILE_BASELINE_KEY = 'baselines/load-profile-{}.json'
+
+#Shadow comparison - with Shadow or ShadowEndpoint in the UserParameters, every batch is also sent to the production
+#endpoint at the same time, to compare the predictions, metrics and latency of both models on the same requests.
+#DeployModel names the production endpoints <training job>-Prod, and the newest of those in service is used.
+PRODUCTION_ENDPOINT_SUFFIX = '-Prod'
+
 def lambda_handler(event, context):
     try:
         
         # Read In CodePipeline Data 
         #    - Previous Event Step Information = Resources created in the previous step (Ex. Hosting Endpoint)
         #    - User Parameters: This function accepts the following User Parameters from CodePipeline
-        #         { "env": "Dev"}
+        #         { "env": "Dev", "BatchRows": 1000, "Cutoff": 0.46, "MinMetrics": {"auc": 0.8, "f1": 0.5}}
         #             where: 
         #                  env = Environment, Valid Values (Dev, Test) 
+        #                  BatchRows = Optional, number of rows sent to the endpoint per request (default 1000)
+        #                  Cutoff = Optional, probability above which a prediction counts as 1 (default 0.46)
+        #                  MinMetrics = Optional, minimum accuracy, precision, recall, f1 and/or auc for the
+        #                               stage to pass
+        #                  LoadProfile = Optional, run a load profile and compare it to the baseline, e.g.
+        #                               {"Concurrency": [1, 4, 16], "PayloadRows": [1, 100], "Seconds": 10}
+        #                               (see DEFAULT_LOAD_PROFILE for all of the settings)
+        #                  Shadow = Optional, true to compare the model with the one on the production endpoint
+        #                  ShadowEndpoint = Optional, compare the model with the one on this endpoint instead
         #                  
            
         
@@ -36,6 +94,19 @@ def lambda_handler(event, context):
             
         environment = test_info["env"]
         print("[INFO]ENVIRONMENT:", environment)
+        batch_rows = int(test_info.get("BatchRows", DEFAULT_BATCH_ROWS))
+        cutoff = float(test_info.get("Cutoff", DEFAULT_CUTOFF))
+        min_metrics = test_info.get("MinMetrics", {})
+        unknown = sorted(set(min_metrics) - set(GATED_METRICS))
+        if unknown:
+            raise Exception('MinMetrics can only set ' + ', '.join(GATED_METRICS) + ', got ' + ', '.join(unknown))
+        load_profile = parse_load_profile(test_info["LoadProfile"]) if "LoadProfile" in test_info else None
+        shadow_endpoint = test_info.get("ShadowEndpoint")
+        if shadow_endpoint is None and test_info.get("Shadow"):
+            shadow_endpoint = find_production_endpoint(endpointName)
+            if shadow_endpoint is None:
+                print("[INFO]No production endpoint in service, skipping the shadow comparison")
+        print("[INFO]Shadow Endpoint:", shadow_endpoint)
         
         # Environment variable containing S3 bucket for data used for validation and/or smoke test
         data_bucket = os.environ['S3DataBucket']
@@ -45,18 +116,20 @@ def lambda_handler(event, context):
         if environment == 'Dev':
             key = 'smoketest/smoketest.csv'
             print("[INFO]Smoke Test Info:"+ environment + " S3 Data Bucket: " + data_bucket + " S3 Prefix/Key: " + key)
-            dev_eval = evaluate_model(data_bucket,key,endpointName)
+            labels, scores, latencies, shadow, skipped_rows = evaluate_model(data_bucket,key,endpointName,batch_rows,
+                                                                             shadow_endpoint)
             print('[SUCCESS] Smoke Test Complete')
-            write_job_info_s3(event)
-            put_job_success(event)
+            gate_stage(event, data_bucket, key, endpointName, environment, labels, scores, cutoff, min_metrics, load_profile,
+                       latencies, shadow, skipped_rows)
         
         elif environment == 'Test':
             key = 'validation/validation.csv'
             print("[INFO]Full Test Info:"+ environment + " S3 Data Bucket: " + data_bucket + " S3 Prefix/Key: " + key)
-            test_eval = evaluate_model(data_bucket,key,endpointName)
+            labels, scores, latencies, shadow, skipped_rows = evaluate_model(data_bucket,key,endpointName,batch_rows,
+                                                                             shadow_endpoint)
             print('[SUCCESS] Full Test Complete')
-            write_job_info_s3(event)
-            put_job_success(event)
+            gate_stage(event, data_bucket, key, endpointName, environment, labels, scores, cutoff, min_metrics, load_profile,
+                       latencies, shadow, skipped_rows)
     
     except Exception as e:
         print(e)
@@ -66,89 +139,225 @@ def lambda_handler(event, context):
 
     return event 
 
+#Compute the classification metrics and run the load profile, write both into the output artifact and pass or fail
+#the stage on MinMetrics and the load profile baseline
+def gate_stage(event, data_bucket, key, endpointName, environment, labels, scores, cutoff, min_metrics, load_profile,
+               latencies, shadow, skipped_rows):
+    
+    evaluation = classification_metrics(labels, scores, cutoff)
+    evaluation['skipped_rows'] = skipped_rows
+    print("[INFO]Evaluation:", json.dumps(dict((name, value) for name, value in evaluation.items() if name != 'threshold_sweep')))
+    
+    failed = []
+    for name, minimum in sorted(min_metrics.items()):
+        if evaluation[name] is None or evaluation[name] < float(minimum):
+            failed.append('{} {} is below the minimum of {}'.format(name, evaluation[name], minimum))
+    evaluation['min_metrics'] = min_metrics
+    evaluation['passed'] = not failed
+    event['evaluation'] = evaluation
+    
+    if shadow is not None:
+        event['shadow'] = shadow_comparison(labels, scores, latencies, shadow, cutoff, evaluation)
+        print("[INFO]Shadow Comparison:", json.dumps(event['shadow']))
+    
+    if load_profile is not None:
+        profile = run_load_profile(data_bucket, key, endpointName, load_profile)
+        baseline = read_load_profile_baseline(data_bucket, environment)
+        profile_failed = compare_load_profile(profile, baseline, load_profile)
+        profile['baseline_endpoint'] = baseline['endpoint'] if baseline else None
+        profile['passed'] = not profile_failed
+        event['load_profile'] = profile
+        failed += profile_failed
+    
+    write_job_info_s3(event)
+    if failed:
+        print("[FAIL] Model Evaluation")
+        event['message'] = '; '.join(failed)
+        put_job_failure(event)
+    else:
+        if load_profile is not None:
+            write_load_profile_baseline(data_bucket, environment, event['load_profile'])
+        put_job_success(event)
+
 #Get test/validation data
-def evaluate_model(data_bucket, key, endpointName):
-    # Get the object from the event and show its content type
+def evaluate_model(data_bucket, key, endpointName, batch_rows=DEFAULT_BATCH_ROWS, shadow_endpoint=None):
+    
+    #Use sagemaker runtime to make predictions after getting data
+    runtime_client = boto3.client('runtime.sagemaker')
+    
+    print ("[INFO]Endpoint Version:", endpointName)
     
-    s3 = boto3.resource('s3')
+    #Labels and predicted probabilities of all rows, compactly, for classification_metrics, and the latency of every
+    #request in seconds
+    labels = array('b')
+    scores = array('d')
+    latencies = array('d')
+    shadow = None
+    if shadow_endpoint is not None:
+        shadow = {'endpoint': shadow_endpoint, 'scores': array('d'), 'latencies': array('d')}
+        executor = ThreadPoolExecutor(max_workers=2)
     
-    download_path='/tmp/tmp.csv'
+    #Remove label - For csv files used for inference, XGBoost assumes that CSV input does not have the label column. 
+    #This processing could alternatively be setup as a pre-processing container behind the hosted endpoint using
+    #inference pipeline capabilities.
+    skipped_rows = [0]
+    rows = stream_labelled_rows(data_bucket, key, skipped_rows)
+    
+    try:
+        for batch_labels, invoke_endpoint_body in make_batches(rows, batch_rows):
+            
+            if shadow is None:
+                predictions, latency = invoke_batch(runtime_client, endpointName, invoke_endpoint_body, len(batch_labels))
+            else:
+                #Send the batch to both endpoints at once, so they see the same traffic at the same time
+                candidate = executor.submit(invoke_batch, runtime_client, endpointName, invoke_endpoint_body, len(batch_labels))
+                production = executor.submit(invoke_batch, runtime_client, shadow_endpoint, invoke_endpoint_body, len(batch_labels))
+                predictions, latency = candidate.result()
+                shadow_predictions, shadow_latency = production.result()
+                shadow['scores'].extend(shadow_predictions)
+                shadow['latencies'].append(shadow_latency)
+            
+            labels.extend(batch_labels)
+            scores.extend(predictions)
+            latencies.append(latency)
+            print("[INFO]Predictions Processed:", len(scores))
+    finally:
+        if shadow is not None:
+            executor.shutdown(wait=True)
+
+    print("[INFO]Number of predictions on input:", len(scores))
+    if skipped_rows[0]:
+        print("[WARN]Rows skipped for a blank or unparsable label:", skipped_rows[0])
+        
+    return labels, scores, latencies, shadow, skipped_rows[0]
 
+#Send one batch of rows to an endpoint. Returns the predicted probabilities and the latency of the request in seconds.
+def invoke_batch(runtime_client, endpointName, invoke_endpoint_body, batch_rows):
+    
+    start = time.time()
+    response = runtime_client.invoke_endpoint(
+        Accept=JSON_CONTENT_TYPE,
+        ContentType="text/csv",
+        Body=invoke_endpoint_body,
+        EndpointName=endpointName
+        )
+    
+    #Check for successful return code (200)
+    return_code = response['ResponseMetadata']['HTTPStatusCode']
+    if return_code != 200:
+        print("[FAIL] Smoke Test")
+        raise Exception('InvokeEndpoint on {} returned {}'.format(endpointName, return_code))
+    
+    #Response body will be of type "<botocore.response.StreamingBody>", with one prediction per row
+    predictions = parse_predictions(response['Body'].read().decode('utf-8'))
+    latency = time.time() - start
+    if len(predictions) != batch_rows:
+        raise Exception('{} returned {} predictions for {} rows'.format(endpointName, len(predictions), batch_rows))
+    return [float(predict_value) for predict_value in predictions], latency
+
+#Return the newest production endpoint in service other than the candidate, or None if there is none
+def find_production_endpoint(endpointName):
+    
+    response = sagemaker.list_endpoints(NameContains=PRODUCTION_ENDPOINT_SUFFIX, StatusEquals='InService',
+                                        SortBy='CreationTime', SortOrder='Descending')
+    for endpoint in response['Endpoints']:
+        name = endpoint['EndpointName']
+        if name.endswith(PRODUCTION_ENDPOINT_SUFFIX) and name != endpointName:
+            return name
+    return None
+
+#Compare the candidate with the production model on the same rows: how often they make the same prediction at the
+#cutoff, the difference of their classification metrics and of their request latency (candidate minus production)
+def shadow_comparison(labels, scores, latencies, shadow, cutoff, evaluation):
+    
+    production = classification_metrics(labels, shadow['scores'], cutoff)
+    rows = len(scores)
+    agreeing = sum(1 for score, shadow_score in zip(scores, shadow['scores']) if (score > cutoff) == (shadow_score > cutoff))
+    
+    def delta(candidate_value, production_value):
+        if candidate_value is None or production_value is None:
+            return None
+        return candidate_value - production_value
+    
+    metrics = {}
+    for name in GATED_METRICS:
+        metrics[name] = {'candidate': evaluation[name], 'production': production[name],
+                         'delta': delta(evaluation[name], production[name])}
+    
+    candidate_latencies = sorted(latencies)
+    production_latencies = sorted(shadow['latencies'])
+    latency_ms = {}
+    for name, p in (('p50', 0.50), ('p95', 0.95), ('p99', 0.99)):
+        candidate_ms = percentile_ms(candidate_latencies, p)
+        production_ms = percentile_ms(production_latencies, p)
+        latency_ms[name] = {'candidate': candidate_ms, 'production': production_ms, 'delta': delta(candidate_ms, production_ms)}
+    
+    return {
+        'production_endpoint': shadow['endpoint'],
+        'rows': rows,
+        'agreement': float(agreeing) / rows if rows else None,
+        'mean_absolute_score_difference': sum(abs(score - shadow_score) for score, shadow_score in zip(scores, shadow['scores'])) / rows if rows else None,
+        'production_confusion_matrix': production['confusion_matrix'],
+        'metrics': metrics,
+        'latency_ms': latency_ms,
+    }
+
+#The p quantile of sorted latencies in seconds, in milliseconds
+def percentile_ms(latencies, p):
+    
+    return round(latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000, 2) if latencies else None
+
+#Read the rows of a CSV object in S3 as it is downloaded, instead of saving it to /tmp first, so neither the size
+#of /tmp nor the memory of the function limits the size of the validation data
+def stream_csv_rows(data_bucket, key):
+    
+    body = boto3.client('s3').get_object(Bucket=data_bucket, Key=key)['Body']
     try:
-        #Use sagemaker runtime to make predictions after getting data
-        runtime_client = boto3.client('runtime.sagemaker')
+        lines = codecs.iterdecode(body.iter_lines(chunk_size=STREAM_CHUNK_BYTES), 'utf-8')
+        for row in csv.reader(lines):
+            if row:
+                yield row
+    finally:
+        body.close()
 
-        response = s3.Bucket(data_bucket).download_file(key, download_path)
+#Read the (label, features) pairs of the rows of a CSV object in S3 that have a label. Rows without one can't be
+#scored, so they are left out and counted in skipped_rows[0].
+def stream_labelled_rows(data_bucket, key, skipped_rows=None):
     
-        csv_data = csv.reader(open(download_path, newline=''))
-        
-        inferences_processed = len(list(csv.reader(open(download_path, newline=''))))
-        inference_count = inferences_processed
-        print("[INFO]Number of predictions on input:", inferences_processed)
-        
-        EndpointInput=endpointName
+    rows = stream_csv_rows(data_bucket, key)
+    try:
+        for row in rows:
+            label = parse_label(row[0])
+            if label is None:
+                if skipped_rows is not None:
+                    skipped_rows[0] += 1
+                continue
+            yield label, row[1:]
+    finally:
+        rows.close()
 
-        print ("[INFO]Endpoint Version:", endpointName)
-        
-        for row in csv_data:
-            
-            print("[INFO]Row to format is:", row)
-            
-            #Remove label - For csv files used for inference, XGBoost assumes that CSV input does not have the label column. 
-            #This processing could alternatively be setup as a pre-processing container behind the hosted endpoint using
-            #inference pipeline capabilities.
-            
-            label_value = row.pop(0)
-            
-            
-            print("[INFO]Row on input is:", row)
-            
-            
-            # Convert to String          
-            formatted_input=csv_formatbody(row)
-            print("[INFO]Formatted Input", formatted_input)
-            
-            # Convert to Bytes
-            invoke_endpoint_body= bytes(formatted_input,'utf-8')
-            print("[INFO]invoke_endpoint_body", invoke_endpoint_body)
-            
-            response = runtime_client.invoke_endpoint(
-                Accept=JSON_CONTENT_TYPE,
-                ContentType="text/csv",
-                Body=invoke_endpoint_body,
-                EndpointName=EndpointInput
-                )
-            #Response body will be of type "<botocore.response.StreamingBody>"
-            #Convert this into string and json for understandable results
-            
-            print("[INFO]InvokeEndpoint Response:", response)
-            #Check for successful return code (200)
-            return_code = response['ResponseMetadata']['HTTPStatusCode']
-            print("[INFO]InvokeEndpoint return_code:", return_code)
-            
-            
-            if return_code != 200:
-                event['message'] = str(return_code)
-                print("[FAIL] Smoke Test")
-                put_job_failure(event)
-                return 'failed'
-            elif return_code == 200:
-                print('[INFO]Predictions Processed')
-
-                actual_response = response['Body'].read().decode('ascii')
-                print('[INFO]Actual_response', actual_response)
-            
-                basic_metric = process_prediction(label_value, actual_response)
-                
-                
+#Group (label, row) pairs into multi-line CSV payloads of at most batch_rows rows and max_bytes bytes
+def make_batches(rows, batch_rows, max_bytes=MAX_PAYLOAD_BYTES):
     
-    except botocore.exceptions.ClientError as e:
-        print(e)
-        print('[ERRORUnable to get predictions')
-        event['message'] = str(e)
-        put_job_failure(e)
-        
-    return return_code
+    labels = []
+    lines = []
+    size = 0
+    for label_value, row in rows:
+        line = (csv_formatbody(row) + '\n').encode('utf-8')
+        if lines and (len(lines) >= batch_rows or size + len(line) > max_bytes):
+            yield labels, b''.join(lines)
+            labels, lines, size = [], [], 0
+        labels.append(label_value)
+        lines.append(line)
+        size += len(line)
+    if lines:
+        yield labels, b''.join(lines)
+
+#The algorithm answers a multi-row CSV request with one prediction per row, either one per line or all on one
+#line separated by commas
+def parse_predictions(actual_response):
+    
+    return [value for value in actual_response.replace('\n', ',').split(',') if value.strip()]
             
     
 #Format Body of inference to match input expected by algorithm
@@ -158,49 +367,210 @@ def csv_formatbody(row):
     
     return string_row
  
-def process_prediction(label_value, actual_response):
-    #PostProcessing - Because we chose binary:logistic as our objective metric, our result for the payload will be
-    # an output probability. We are going to use the same optimal cutoff detailed in the example notebook; however, this
-    # would be configurable based on post-processing evaluation of impact. 
-    #This processing could alternatively be setup as a post-processing container behind the hosted endpoint using
-    #inference pipeline capabilities.
+#Returns None for a blank or unparsable label, which stream_labelled_rows skips
+def parse_label(label_value):
     
-    response_cutoff = 0.46   
-    #label = float(label_value)
-    #print("Label:", label)
-    predict_value = float(actual_response) 
-    print("predict_value", predict_value)
+    try:
+        label = int(float(label_value))
+    except (ValueError, OverflowError):
+        return None
+    if label not in (0, 1):
+        raise Exception('The labels of a binary classifier must be 0 or 1, got ' + label_value)
+    return label
+
+#Confusion matrix, precision, recall, F1, AUC and a sweep over cutoffs of the predicted probabilities. The scores of
+#each class are sorted once, after which the rows above any cutoff are counted with a binary search, rather than
+#thresholding every row again for every cutoff.
+def classification_metrics(labels, scores, cutoff):
     
-    if predict_value > response_cutoff:
-        prediction = '1'
-        print('[INFO]Prediction is:', prediction)
-    else:
-        prediction = '0'
-        print('[INFO]Prediction is:', prediction)
-    
-    labeltype = type(label_value)
-    print("LabelType", labeltype)
-    predictiontype = type(prediction)
-    print("PredictionType", predictiontype)
-    
-    if label_value == 0 and prediction == 0:
-        # True Negative
-        basic_metric = 'TN'
-    elif label_value == 0 and prediction == 1:
-        # False Positive
-        basic_metric = 'FP'
-    elif label_value == 1 and prediction == 0:
-        # False Negative
-        basic_metric = 'FN'
-    else:
-        # True Positive
-        basic_metric = 'TP'
-        
-    print("[INFO] Label:" + label_value + "| Prediction:" + prediction + " | Metric Response:" + basic_metric)
-                
-    return basic_metric
+    positives = sorted(score for label, score in zip(labels, scores) if label == 1)
+    negatives = sorted(score for label, score in zip(labels, scores) if label == 0)
+    
+    evaluation = confusion_metrics(positives, negatives, cutoff)
+    evaluation['rows'] = len(scores)
+    evaluation['auc'] = area_under_curve(positives, negatives)
+    evaluation['threshold_sweep'] = [confusion_metrics(positives, negatives, threshold) for threshold in SWEEP_THRESHOLDS]
+    return evaluation
+
+def confusion_metrics(positives, negatives, cutoff):
+    
+    # A prediction counts as 1 if its probability is above the cutoff
+    tp = len(positives) - bisect.bisect_right(positives, cutoff)
+    fp = len(negatives) - bisect.bisect_right(negatives, cutoff)
+    fn = len(positives) - tp
+    tn = len(negatives) - fp
+    precision = float(tp) / (tp + fp) if tp + fp else 0.0
+    recall = float(tp) / (tp + fn) if tp + fn else 0.0
+    return {
+        'cutoff': cutoff,
+        'confusion_matrix': {'TP': tp, 'FP': fp, 'TN': tn, 'FN': fn},
+        'accuracy': float(tp + tn) / (tp + fp + tn + fn) if tp + fp + tn + fn else 0.0,
+        'precision': precision,
+        'recall': recall,
+        'f1': 2 * precision * recall / (precision + recall) if precision + recall else 0.0,
+    }
+
+#The probability that a random positive row scores above a random negative one, counting ties as half, which is the
+#area under the ROC curve. None if the data holds only one of the classes.
+def area_under_curve(positives, negatives):
+    
+    if not positives or not negatives:
+        return None
+    wins = 0.0
+    for score in positives:
+        below = bisect.bisect_left(negatives, score)
+        ties = bisect.bisect_right(negatives, score) - below
+        wins += below + 0.5 * ties
+    return wins / (len(positives) * len(negatives))
                 
                 
+def parse_load_profile(settings):
+    
+    unknown = sorted(set(settings) - set(DEFAULT_LOAD_PROFILE))
+    if unknown:
+        raise Exception('LoadProfile can only set ' + ', '.join(sorted(DEFAULT_LOAD_PROFILE)) + ', got ' + ', '.join(unknown))
+    load_profile = dict(DEFAULT_LOAD_PROFILE, **settings)
+    total_seconds = len(load_profile['Concurrency']) * len(load_profile['PayloadRows']) * load_profile['Seconds']
+    if total_seconds > MAX_LOAD_PROFILE_SECONDS:
+        raise Exception('The load profile would run for {} seconds, more than the {} the Lambda timeout leaves for it'.format(
+            total_seconds, MAX_LOAD_PROFILE_SECONDS))
+    return load_profile
+
+#Put the endpoint under load at every concurrency of the ramp, for every payload size, and record the latency
+#percentiles, error rate and throughput of each step, and the highest throughput sustained without too many errors
+def run_load_profile(data_bucket, key, endpointName, load_profile):
+    
+    max_concurrency = max(load_profile['Concurrency'])
+    #A connection for each thread, and no retries, so that throttling shows up as errors
+    runtime_client = boto3.client('runtime.sagemaker', config=botocore.config.Config(
+        max_pool_connections=max_concurrency, retries={'max_attempts': 1, 'mode': 'standard'}))
+    
+    #The payloads are made of the first rows of the validation data that the evaluation scored, without the label
+    rows = stream_labelled_rows(data_bucket, key)
+    try:
+        sample = [row for _, row in itertools.islice(rows, max(load_profile['PayloadRows']))]
+    finally:
+        rows.close()
+    if not sample:
+        raise ValueError('The validation data ' + key + ' has no labelled rows to build the load profile from')
+    
+    steps = []
+    max_sustainable_rps = {}
+    for payload_rows in sorted(load_profile['PayloadRows']):
+        #Repeat the sample if the validation data has fewer rows than the payload
+        payload = [sample[i % len(sample)] for i in range(payload_rows)]
+        body = ''.join(csv_formatbody(row) + '\n' for row in payload).encode('utf-8')
+        sustainable = 0.0
+        for concurrency in sorted(load_profile['Concurrency']):
+            step = run_load_step(runtime_client, endpointName, body, concurrency, load_profile['Seconds'])
+            step['payload_rows'] = payload_rows
+            print("[INFO]Load Profile Step:", json.dumps(step))
+            steps.append(step)
+            if step['error_rate'] <= load_profile['MaxErrorRate']:
+                sustainable = max(sustainable, step['rps'])
+        max_sustainable_rps[str(payload_rows)] = sustainable
+    
+    return {'endpoint': endpointName, 'settings': load_profile, 'steps': steps, 'max_sustainable_rps': max_sustainable_rps}
+
+#Invoke the endpoint with body from concurrency threads for the given number of seconds
+def run_load_step(runtime_client, endpointName, body, concurrency, seconds):
+    
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.time() + seconds
+    
+    def run():
+        ok = []
+        failed = 0
+        while time.time() < deadline:
+            start = time.time()
+            try:
+                response = runtime_client.invoke_endpoint(
+                    Accept=JSON_CONTENT_TYPE,
+                    ContentType="text/csv",
+                    Body=body,
+                    EndpointName=endpointName
+                    )
+                response['Body'].read()
+                ok.append(time.time() - start)
+            except (botocore.exceptions.ClientError, botocore.exceptions.BotoCoreError):
+                #Throttling and errors of the model, and timeouts and dropped connections
+                failed += 1
+        with lock:
+            latencies.extend(ok)
+            errors[0] += failed
+    
+    start = time.time()
+    threads = [threading.Thread(target=run) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    
+    latencies.sort()
+    requests = len(latencies) + errors[0]
+    return {
+        'concurrency': concurrency,
+        'requests': requests,
+        'errors': errors[0],
+        'error_rate': float(errors[0]) / requests if requests else 0.0,
+        'rps': round(len(latencies) / elapsed, 2),
+        'p50_ms': percentile_ms(latencies, 0.50),
+        'p95_ms': percentile_ms(latencies, 0.95),
+        'p99_ms': percentile_ms(latencies, 0.99),
+    }
+
+#Return why the load profile fails, compared to the baseline if there is one: a payload size with no step within
+#MaxErrorRate, p50 or p95 latency above the baseline's by more than MaxLatencyRegression at the same step, or less
+#sustainable throughput than the baseline's by more than MaxThroughputRegression. p99 is recorded but not compared,
+#a few slow requests make it too noisy for a gate at these numbers of requests.
+def compare_load_profile(profile, baseline, load_profile):
+    
+    failed = []
+    for payload_rows, rps in sorted(profile['max_sustainable_rps'].items()):
+        if not rps:
+            failed.append('no load step with {} row payloads stayed within the error rate of {}'.format(payload_rows, load_profile['MaxErrorRate']))
+    if baseline is None:
+        print("[INFO]No load profile baseline yet, this profile becomes the baseline if the stage passes")
+        return failed
+    
+    baseline_steps = dict(((step['payload_rows'], step['concurrency']), step) for step in baseline['steps'])
+    for step in profile['steps']:
+        baseline_step = baseline_steps.get((step['payload_rows'], step['concurrency']))
+        if baseline_step is None:
+            continue
+        for percentile in ('p50_ms', 'p95_ms'):
+            if step[percentile] is None or baseline_step[percentile] is None:
+                continue
+            limit = baseline_step[percentile] * (1 + load_profile['MaxLatencyRegression'])
+            if step[percentile] > limit:
+                failed.append('{} latency of {} ms with {} row payloads at concurrency {} is above the baseline of {} ms'.format(
+                    percentile[:3], step[percentile], step['payload_rows'], step['concurrency'], baseline_step[percentile]))
+    for payload_rows, rps in sorted(profile['max_sustainable_rps'].items()):
+        baseline_rps = baseline['max_sustainable_rps'].get(payload_rows)
+        if baseline_rps and rps < baseline_rps * (1 - load_profile['MaxThroughputRegression']):
+            failed.append('sustainable throughput of {} requests/s with {} row payloads is below the baseline of {}'.format(
+                rps, payload_rows, baseline_rps))
+    return failed
+
+def read_load_profile_baseline(data_bucket, environment):
+    
+    try:
+        obj = boto3.client('s3').get_object(Bucket=data_bucket, Key=LOAD_PROFILE_BASELINE_KEY.format(environment))
+    except botocore.exceptions.ClientError as e:
+        if e.response.get('Error', {}).get('Code') == 'NoSuchKey':
+            return None
+        raise
+    return json.loads(obj['Body'].read().decode('utf-8'))
+
+def write_load_profile_baseline(data_bucket, environment, profile):
+    
+    baseline_key = LOAD_PROFILE_BASELINE_KEY.format(environment)
+    print("[INFO]Recording the load profile baseline:", baseline_key)
+    boto3.client('s3').put_object(Bucket=data_bucket, Key=baseline_key, Body=json.dumps(profile).encode('utf-8'))
+
 def write_job_info_s3(event):
     
     KMSKeyIdSSEIn = os.environ['SSEKMSKeyIdIn']
@@ -1,7 +1,13 @@
 import boto3
 import os
+import codecs
+import collections
 import csv
 import botocore
+import botocore.config
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
 from time import gmtime, strftime
 from boto3.session import Session
 import json
@@ -12,15 +18,31 @@ code_pipeline = boto3.client('codepipeline')
 #use json to send data to model and get back the prediction.
 JSON_CONTENT_TYPE = "text/csv"
 
+#Rows are sent to the endpoint by a pool of Concurrency threads (see UserParameters), which share one client
+DEFAULT_CONCURRENCY = 8
+DEFAULT_MAX_RETRIES = 5
+
+#Errors worth retrying, with exponential backoff and jitter: the endpoint is throttling or briefly unavailable
+RETRYABLE_ERRORS = ('ThrottlingException', 'ServiceUnavailable', 'InternalFailure', 'ModelNotReadyException')
+RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+BASE_BACKOFF_SECONDS = 0.1
+MAX_BACKOFF_SECONDS = 10
+
+#Rows read ahead of the predictions, per thread, and bytes of the validation data read from S3 at a time
+QUEUED_ROWS_PER_THREAD = 4
+STREAM_CHUNK_BYTES = 64 * 1024
+
 def lambda_handler(event, context):
     try:
         
         # Read In CodePipeline Data 
         #    - Previous Event Step Information = Resources created in the previous step (Ex. Hosting Endpoint)
         #    - User Parameters: This function accepts the following User Parameters from CodePipeline
-        #         { "env": "Dev"}
+        #         { "env": "Dev", "Concurrency": 8, "MaxRetries": 5}
         #             where: 
         #                  env = Environment, Valid Values (Dev, Test) 
+        #                  Concurrency = Optional, number of requests in flight to the endpoint (default 8)
+        #                  MaxRetries = Optional, retries of a throttled or failed request (default 5)
 
         
         previousStepEvent = read_job_info(event)
@@ -31,6 +53,8 @@ def lambda_handler(event, context):
             
         environment = test_info["env"]
         print("[INFO]ENVIRONMENT:", environment)
+        concurrency = int(test_info.get("Concurrency", DEFAULT_CONCURRENCY))
+        max_retries = int(test_info.get("MaxRetries", DEFAULT_MAX_RETRIES))
         
         # Environment variable containing S3 bucket for data used for validation and/or smoke test
         data_bucket = os.environ['S3DataBucket']
@@ -39,7 +63,7 @@ def lambda_handler(event, context):
         if environment == 'Dev':
             print('[INFO]Start Smoke Test')
             key = 'smoketest/smoketest.csv'
-            dev_eval = evaluate_model(data_bucket,key,endpointName)
+            dev_eval = evaluate_model(data_bucket,key,endpointName,concurrency,max_retries)
             print('[SUCCESS]Smoke Test Complete')
             write_job_info_s3(event)
             put_job_success(event)
@@ -47,7 +71,7 @@ def lambda_handler(event, context):
         elif environment == 'Test':
             print('[INFO]Start Full Test')
             key = 'validation/validation.csv'
-            test_eval = evaluate_model(data_bucket,key,endpointName)
+            test_eval = evaluate_model(data_bucket,key,endpointName,concurrency,max_retries)
             print('[SUCCESS] Full Test Complete')
             write_job_info_s3(event)
             put_job_success(event)
@@ -61,81 +85,94 @@ def lambda_handler(event, context):
     return event 
 
 #Get test/validation data
-def evaluate_model(data_bucket, key, endpointName):
-    # Get the object from the event and show its content type
-    
-    s3 = boto3.resource('s3')
+def evaluate_model(data_bucket, key, endpointName, concurrency=DEFAULT_CONCURRENCY, max_retries=DEFAULT_MAX_RETRIES):
     
-    download_path='/tmp/tmp.csv'
+    #Use sagemaker runtime to make predictions after getting data. The client is shared by all threads, with a
+    #connection for each, and retries are left to invoke_with_retry
+    runtime_client = boto3.client('runtime.sagemaker', config=botocore.config.Config(
+        max_pool_connections=concurrency, retries={'max_attempts': 1, 'mode': 'standard'}))
 
+    print("[INFO]Endpoint Version:", endpointName)
+    
+    def invoke(row):
+        # Convert to String, then to Bytes
+        invoke_endpoint_body = bytes(csv_formatbody(row), 'utf-8')
+        response = invoke_with_retry(runtime_client, endpointName, invoke_endpoint_body, max_retries)
+        #Check for successful return code (200)
+        return_code = response['ResponseMetadata']['HTTPStatusCode']
+        if return_code != 200:
+            print("[FAIL] Invoke Endpoint did not return 200 code")
+            raise Exception('InvokeEndpoint returned ' + str(return_code))
+        #Response body will be of type "<botocore.response.StreamingBody>"
+        return response['Body'].read().decode('utf-8').strip()
+    
+    #The rows are read from S3 as they are needed, and the predictions taken in the order of the rows, however the
+    #requests complete. Only a bounded window of rows is queued, so memory does not grow with the validation data.
+    def ordered_predictions(executor):
+        pending = collections.deque()
+        try:
+            # Example: ['setosa', '5.0', '3.5', '1.3', '0.3']
+            for row in stream_csv_rows(data_bucket, key):
+                pending.append(executor.submit(invoke, row))
+                if len(pending) >= concurrency * QUEUED_ROWS_PER_THREAD:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            # If a request failed, don't send the rows that are still queued
+            for future in pending:
+                future.cancel()
+    
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    sample = []
+    inferences_processed = 0
     try:
-        #Use sagemaker runtime to make predictions after getting data
-        runtime_client = boto3.client('runtime.sagemaker')
-
-        response = s3.Bucket(data_bucket).download_file(key, download_path)
-
-        csv_data = csv.reader(open(download_path, newline=''))
-        
-        inferences_input = len(list(csv.reader(open(download_path, newline=''))))
-        inference_count = inferences_input
-        print("[INFO]Number of predictions on input:", inferences_input)
+        for prediction in ordered_predictions(executor):
+            inferences_processed += 1
+            if len(sample) < 10:
+                sample.append(prediction)
+            if inferences_processed % 1000 == 0:
+                print('[INFO]Predictions Processed:', inferences_processed)
+    finally:
+        executor.shutdown(wait=True)
+    
+    print('[INFO]Predictions Processed:', inferences_processed)
+    print('[INFO]Our results for the first payloads are:', sample)
         
-        EndpointInput=endpointName
+    return inferences_processed
 
-        print ("[INFO]Endpoint Version:", endpointName)
-        
-        inferences_processed = 0 
-        
-        
-        for row in csv_data:
-            
-            
-            print("[INFO]Row to format is:", row)
-            # Example: ['setosa', '5.0', '3.5', '1.3', '0.3']
-            
-            # Convert to String          
-            formatted_input=csv_formatbody(row)
-            print("[INFO]Formatted Input:", formatted_input)
-            
-            # Convert to Bytes
-            invoke_endpoint_body= bytes(formatted_input,'utf-8')
-            print("[INFO]invoke_endpoint_body:", invoke_endpoint_body)
-            
-            response = runtime_client.invoke_endpoint(
+#Read the rows of a CSV object in S3 as it is downloaded, instead of saving it to /tmp first, so neither the size
+#of /tmp nor the memory of the function limits the size of the validation data
+def stream_csv_rows(data_bucket, key):
+    
+    body = boto3.client('s3').get_object(Bucket=data_bucket, Key=key)['Body']
+    try:
+        lines = codecs.iterdecode(body.iter_lines(chunk_size=STREAM_CHUNK_BYTES), 'utf-8')
+        for row in csv.reader(lines):
+            if row:
+                yield row
+    finally:
+        body.close()
+
+#Invoke the endpoint, retrying throttled and transiently failed requests with exponential backoff and full jitter
+def invoke_with_retry(runtime_client, endpointName, body, max_retries):
+    
+    for attempt in range(max_retries + 1):
+        try:
+            return runtime_client.invoke_endpoint(
                 Accept=JSON_CONTENT_TYPE,
                 ContentType="text/csv",
-                Body=invoke_endpoint_body,
-                EndpointName=EndpointInput
+                Body=body,
+                EndpointName=endpointName
                 )
-            #Response body will be of type "<botocore.response.StreamingBody>"
-            #Convert this into string and json for understandable results
-            #Check for successful return code (200)
-            return_code = response['ResponseMetadata']['HTTPStatusCode']
-            print("[INFO]InvokeEndpoint return_code:", return_code)
-            
-            print('[INFO]Our result for this payload is: {}'.format(response['Body'].read().decode('ascii')))
-            
-            if return_code != 200:
-                event['message'] = str(return_code)
-                print("[FAIL] Invoke Endpoint did not return 200 code")
-                put_job_failure(event)
-                return 'failed'
-            elif return_code == 200:
-                inferences_processed = inferences_processed + 1
-                inference_count = inference_count - 1 
-                print('[INFO]Prediction Processed:', inferences_processed)
-                print('[INFO]Prediction Remaining on Input:', inference_count)
-                
-            if inference_count==0:
-                return
-                
-    except botocore.exceptions.ClientError as e:
-           print(e)
-           print('[FAIL]Unable to get predictions')
-           event['message'] = str(e)
-           put_job_failure(e)
-        
-    return return_code
+        except botocore.exceptions.ClientError as e:
+            code = e.response.get('Error', {}).get('Code')
+            status = e.response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+            if attempt == max_retries or (code not in RETRYABLE_ERRORS and status not in RETRYABLE_STATUS_CODES):
+                raise
+            delay = random.uniform(0, min(MAX_BACKOFF_SECONDS, BASE_BACKOFF_SECONDS * 2 ** attempt))
+            print('[WARN]InvokeEndpoint failed with {}, retrying in {:.2f} seconds'.format(code or status, delay))
+            time.sleep(delay)
             
     
 #Format Body of inference to match input expected by algorithm
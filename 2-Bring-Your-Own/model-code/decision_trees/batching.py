@@ -0,0 +1,121 @@
+# Server-side micro-batching. When many small requests arrive at once, each call to the model pays a fixed
+# overhead (input validation, dispatch into the tree code) that dwarfs the work per row. The MicroBatcher
+# coalesces the rows of concurrent requests in a worker into one predict call and hands every request back
+# its own slice of the predictions.
+#
+# Concurrency within a worker comes from gevent greenlets or gthread threads; threading primitives are used,
+# which gevent's monkey patching makes greenlet aware. No background thread is started: the first request to
+# arrive leads the batch, so the batcher is safe to create before gunicorn forks its workers.
+
+from __future__ import print_function
+
+import threading
+import time
+
+import numpy as np
+
+from metrics import Histogram
+
+
+class _Batch(object):
+    def __init__(self, columns, args):
+        self.columns = columns
+        self.args = args
+        self.parts = []
+        self.rows = 0
+        self.closed = threading.Event()
+        self.done = threading.Event()
+        self.results = None
+
+
+class MicroBatcher(object):
+    """Coalesces rows from concurrent requests into a single call of predict_fn.
+
+    Args:
+        predict_fn: function that takes a 2-D array of rows and returns one prediction per row.
+        max_batch_rows: a batch is run as soon as it holds this many rows. Requests at least this large
+            skip batching altogether.
+        max_wait_ms: the longest the first request of a batch waits for others to join it.
+        log_interval: seconds between the batch size summaries printed to the log, 0 to disable.
+    """
+
+    def __init__(self, predict_fn, max_batch_rows, max_wait_ms, log_interval=60):
+        self.predict_fn = predict_fn
+        self.max_batch_rows = max_batch_rows
+        self.max_wait = max_wait_ms / 1000.0
+        self.log_interval = log_interval
+        self.batch_rows = Histogram([1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024])
+        self.batch_requests = Histogram([1, 2, 4, 8, 16, 32, 64])
+        self._lock = threading.Lock()
+        self._open = None
+        self._last_log = time.time()
+
+    def predict(self, data, *args):
+        """Predict data (a 2-D array or dataframe) together with any other requests arriving in the same window.
+        Extra arguments are passed on to predict_fn, and only requests with equal arguments share a batch."""
+        rows, columns = data.shape
+        if rows >= self.max_batch_rows:
+            return self.predict_fn(data, *args)
+
+        with self._lock:
+            batch = self._open
+            if batch is not None and (batch.columns != columns or batch.args != args or batch.rows + rows > self.max_batch_rows):
+                # This request does not fit in the open batch, so close that one and lead a new batch
+                batch.closed.set()
+                batch = None
+            leader = batch is None
+            if leader:
+                batch = self._open = _Batch(columns, args)
+            index = len(batch.parts)
+            batch.parts.append(data)
+            batch.rows += rows
+            if batch.rows >= self.max_batch_rows:
+                batch.closed.set()
+            if batch.closed.is_set() and self._open is batch:
+                self._open = None
+
+        if leader:
+            batch.closed.wait(self.max_wait)
+            with self._lock:
+                if self._open is batch:
+                    self._open = None
+            self._run(batch)
+        else:
+            batch.done.wait()
+
+        result = batch.results[index]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def _run(self, batch):
+        try:
+            parts = batch.parts
+            if len(parts) == 1:
+                batch.results = [self._predict_one(parts[0], batch.args)]
+            else:
+                try:
+                    predictions = self.predict_fn(np.concatenate([np.asarray(part) for part in parts]), *batch.args)
+                    offsets = np.cumsum([len(part) for part in parts])[:-1]
+                    batch.results = np.split(predictions, offsets)
+                except Exception:
+                    # Retry the requests one by one so a single bad request does not fail the others
+                    batch.results = [self._predict_one(part, batch.args) for part in parts]
+            self.batch_rows.observe(batch.rows)
+            self.batch_requests.observe(len(parts))
+        finally:
+            batch.done.set()
+        self._log()
+
+    def _predict_one(self, data, args):
+        try:
+            return self.predict_fn(data, *args)
+        except Exception as e:
+            return e
+
+    def _log(self):
+        now = time.time()
+        if self.log_interval and now - self._last_log >= self.log_interval:
+            self._last_log = now
+            print('Batch rows: {}'.format(self.batch_rows.summary()))
+            print('Batch requests: {}'.format(self.batch_requests.summary()))
@@ -0,0 +1,163 @@
+# Parallel loading of the training channel. Reading every file with pandas and concatenating the dataframes
+# holds the data twice at the peak and parses one file at a time. Instead, the files are parsed concurrently by
+# a pool of processes, which write their features straight into one float32 matrix in shared memory, allocated
+# up front from a first pass that counts the lines of every file.
+#
+# float32 is also what scikit-learn's trees work in, so fitting a tree on the matrix does not copy it again.
+#
+# In Pipe mode the channel is a FIFO rather than files, and load_csv_stream builds the matrix incrementally as
+# the data arrives. For data that does not fit in memory at all, iter_file_chunks and iter_stream_chunks hand
+# out the records a chunk at a time instead.
+
+import io
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
+
+import numpy as np
+import pandas as pd
+
+_BLOCK_SIZE = 1 << 20
+
+# Bytes of a stream parsed at a time by load_csv_stream
+STREAM_CHUNK_SIZE = 16 << 20
+
+# Set in each worker process by _init_worker
+_features = None
+
+
+def count_rows(path):
+    """Return (rows, columns) of the CSV file at path. rows counts every line, blank ones included, so it is
+    an upper bound of the number of records; columns is taken from the first line."""
+    rows = 0
+    first_line = None
+    last = b'\n'
+    with open(path, 'rb') as inp:
+        for block in iter(lambda: inp.read(_BLOCK_SIZE), b''):
+            if first_line is None:
+                first_line = block.split(b'\n', 1)[0]
+            rows += block.count(b'\n')
+            last = block[-1:]
+    if last != b'\n':
+        rows += 1
+    columns = first_line.count(b',') + 1 if first_line and first_line.strip() else 0
+    return rows, columns
+
+def _parse(source, columns, path):
+    """Parse CSV with a label column and columns float32 feature columns into a dataframe."""
+    dtype = dict((column, np.float32) for column in range(1, columns + 1))
+    data = pd.read_csv(source, header=None, dtype=dtype)
+    if data.shape[1] != columns + 1:
+        raise ValueError('{} has {} columns, expected {}'.format(path, data.shape[1], columns + 1))
+    return data
+
+def _init_worker(shared, rows, columns):
+    global _features
+    _features = np.frombuffer(shared, dtype=np.float32).reshape(rows, columns)
+
+def _load_file(job):
+    """Parse one file into rows offset onwards of the shared feature matrix and return its labels."""
+    path, offset, columns = job
+    data = _parse(path, columns, path)
+    _features[offset:offset + len(data)] = data.iloc[:, 1:].values
+    return data.iloc[:, 0].values
+
+def load_csv_files(paths, processes=None):
+    """Load CSV files with the label in the first column and float features in the others.
+
+    Returns (labels, features): a 1-D array of labels and a C-contiguous float32 matrix of features with one
+    row per record, in the order of paths. Raises ValueError if the files do not all have the same number of
+    columns."""
+    # Counting only scans for newlines, so it runs at disk speed and leaves the files in the page cache for parsing
+    counts = [count_rows(path) for path in paths]
+    widths = set(columns for rows, columns in counts if rows and columns)
+    if len(widths) != 1:
+        raise ValueError('The training files must all have the same number of columns, got {}'.format(sorted(widths)))
+    columns = widths.pop() - 1
+    offsets = np.cumsum([0] + [rows for rows, _ in counts])
+    total = int(offsets[-1])
+
+    processes = min(processes or multiprocessing.cpu_count(), len(paths))
+    shared = RawArray('f', total * columns)
+    jobs = [(path, int(offset), columns) for path, offset, (rows, _) in zip(paths, offsets, counts) if rows]
+    if processes > 1:
+        pool = multiprocessing.Pool(processes, initializer=_init_worker, initargs=(shared, total, columns))
+        try:
+            labels = pool.map(_load_file, jobs, chunksize=1)
+        finally:
+            pool.terminate()
+    else:
+        _init_worker(shared, total, columns)
+        labels = [_load_file(job) for job in jobs]
+
+    # Files with blank lines hold fewer records than counted, so close the gaps they leave. Every file moves
+    # to a lower or equal offset, so moving them in order never overwrites rows that are still to be moved.
+    features = np.frombuffer(shared, dtype=np.float32).reshape(total, columns)
+    end = 0
+    for (_, offset, _), file_labels in zip(jobs, labels):
+        if offset != end:
+            features[end:end + len(file_labels)] = features[offset:offset + len(file_labels)]
+        end += len(file_labels)
+    return np.concatenate(labels), features[:end]
+
+def first_line_columns(path):
+    """Return the number of feature columns (all but the label) on the first line of the CSV file at path."""
+    with open(path, 'rb') as inp:
+        line = inp.readline()
+    return line.count(b',') if line.strip() else None
+
+def iter_file_chunks(paths, chunk_rows):
+    """Yield (labels, features) for chunks of at most chunk_rows records of the CSV files at paths, so that
+    only one chunk is in memory at a time. Raises ValueError if the files differ in their number of columns."""
+    columns = None
+    for path in paths:
+        file_columns = first_line_columns(path)
+        if file_columns is None:
+            continue
+        if columns is not None and file_columns != columns:
+            raise ValueError('{} has {} columns, expected {}'.format(path, file_columns + 1, columns + 1))
+        columns = file_columns
+        dtype = dict((column, np.float32) for column in range(1, columns + 1))
+        for data in pd.read_csv(path, header=None, dtype=dtype, chunksize=chunk_rows):
+            yield data.iloc[:, 0].values, np.ascontiguousarray(data.iloc[:, 1:].values)
+
+def iter_stream_chunks(inp, name='stream', chunk_size=STREAM_CHUNK_SIZE):
+    """Yield (labels, features) for every chunk_size bytes or so of CSV records read from the binary file
+    object inp, such as a Pipe mode FIFO. Raises ValueError if the lines differ in their number of columns."""
+    columns = None
+    pending = b''
+    while True:
+        block = inp.read(chunk_size)
+        data = pending + block
+        # Parse complete lines only, the rest of the last one comes with the next block
+        end = len(data) if not block else data.rfind(b'\n') + 1
+        chunk, pending = data[:end], data[end:]
+        if chunk.strip():
+            if columns is None:
+                columns = chunk.lstrip().split(b'\n', 1)[0].count(b',')
+            parsed = _parse(io.BytesIO(chunk), columns, name)
+            yield parsed.iloc[:, 0].values, np.ascontiguousarray(parsed.iloc[:, 1:].values)
+        if not block:
+            return
+
+def load_csv_stream(inp, name='stream', chunk_size=STREAM_CHUNK_SIZE):
+    """Load CSV records with the label in the first column from the binary file object inp, such as a Pipe
+    mode FIFO, parsing them chunk by chunk as they arrive.
+
+    Returns (labels, features) like load_csv_files. The feature matrix grows in place as chunks are parsed,
+    so apart from the chunk being parsed no second copy of the data is held. Raises ValueError if the stream
+    is empty or its lines do not all have the same number of columns."""
+    features = None
+    labels = []
+    rows = 0
+    for chunk_labels, chunk_features in iter_stream_chunks(inp, name, chunk_size):
+        if features is None:
+            features = np.empty((0, chunk_features.shape[1]), dtype=np.float32)
+        if rows + len(chunk_features) > len(features):
+            # Doubling keeps the number of copies low, and resize can often grow the buffer in place
+            features.resize((max(2 * len(features), rows + len(chunk_features)), features.shape[1]), refcheck=False)
+        features[rows:rows + len(chunk_features)] = chunk_features
+        labels.append(chunk_labels)
+        rows += len(chunk_features)
+    if not rows:
+        raise ValueError('{} holds no records'.format(name))
+    return np.concatenate(labels), features[:rows]
@@ -0,0 +1,132 @@
+# A decision tree stored as flat NumPy arrays, one entry per node. This is the model format the container
+# uses for memory-mapped serving: train writes the arrays as .npy files next to the pickled model, and the
+# inference server maps them read-only, so loading takes the same time whatever the size of the tree and all
+# the gunicorn workers share the same physical pages through the page cache.
+#
+# Unpickling a scikit-learn tree can't give the same result, because the tree's __setstate__ copies its node
+# arrays into memory owned by each process.
+#
+# The bundle is a directory holding:
+#
+#   feature.npy, threshold.npy            the split of each internal node
+#   children_left.npy, children_right.npy the child node ids, -1 for leaves
+#   leaf_class.npy                        the index into classes of each node's majority class
+#   classes.npy                           the class labels
+#   tree.json                             format version and number of features
+
+import json
+import os
+
+import numpy as np
+
+FORMAT_VERSION = 1
+
+TREE_LEAF = -1
+
+# Batches up to this size are walked down the tree one row at a time, which beats the fixed cost of the
+# NumPy calls made at every level of the vectorized traversal
+SCALAR_ROWS = 16
+
+_arrays = ['feature', 'threshold', 'children_left', 'children_right', 'leaf_class']
+
+text_type = type(u'')
+
+
+class FlatTree(object):
+    """A fitted single-output decision tree classifier that predicts from flat node arrays."""
+
+    def __init__(self, feature, threshold, children_left, children_right, leaf_class, classes, n_features):
+        self.feature = feature
+        self.threshold = threshold
+        self.children_left = children_left
+        self.children_right = children_right
+        self.leaf_class = leaf_class
+        self.classes = classes
+        self.n_features_ = n_features
+
+    @property
+    def node_count(self):
+        return len(self.feature)
+
+    @classmethod
+    def from_estimator(cls, clf):
+        """Export the node arrays of a fitted scikit-learn DecisionTreeClassifier."""
+        tree = clf.tree_
+        if tree.n_outputs != 1:
+            raise ValueError('Only single-output decision trees can be exported, this one has {} outputs'.format(tree.n_outputs))
+        classes = np.asarray(clf.classes_)
+        if classes.dtype.kind == 'O':
+            classes = classes.astype(text_type)
+        return cls(feature=tree.feature.astype(np.int32),
+                   threshold=tree.threshold.astype(np.float64),
+                   children_left=tree.children_left.astype(np.int32),
+                   children_right=tree.children_right.astype(np.int32),
+                   leaf_class=np.argmax(tree.value[:, 0, :], axis=1).astype(np.int32),
+                   classes=classes,
+                   n_features=int(tree.n_features))
+
+    def save(self, path):
+        """Write the tree as a bundle directory at path."""
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        for name in _arrays:
+            np.save(os.path.join(path, name + '.npy'), getattr(self, name), allow_pickle=False)
+        np.save(os.path.join(path, 'classes.npy'), self.classes, allow_pickle=False)
+        with open(os.path.join(path, 'tree.json'), 'w') as out:
+            json.dump({'format_version': FORMAT_VERSION, 'n_features': self.n_features_}, out)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """Load a bundle directory. By default the node arrays are memory-mapped read-only rather than read."""
+        with open(os.path.join(path, 'tree.json'), 'r') as inp:
+            meta = json.load(inp)
+        if meta.get('format_version') != FORMAT_VERSION:
+            raise ValueError('Unsupported tree bundle format version {}'.format(meta.get('format_version')))
+        arrays = dict((name, np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode)) for name in _arrays)
+        classes = np.load(os.path.join(path, 'classes.npy'), allow_pickle=False)
+        return cls(classes=classes, n_features=meta['n_features'], **arrays)
+
+    def apply(self, X):
+        """Return the id of the leaf that each row of X ends up in.
+
+        Small batches are walked one row at a time. Larger ones descend the tree together, one level per
+        iteration, and rows are dropped from the working set as soon as they reach a leaf. Features are
+        compared as float32, like scikit-learn does, so the leaves are exactly the ones scikit-learn would pick."""
+        X = np.asarray(X, dtype=np.float32)
+        if X.ndim != 2 or X.shape[1] != self.n_features_:
+            raise ValueError('Expected input with {} features, got shape {}'.format(self.n_features_, X.shape))
+        if not np.isfinite(X).all():
+            raise ValueError('Input contains NaN, infinity or a value too large for dtype float32')
+        if len(X) <= SCALAR_ROWS:
+            return self._apply_rows(X)
+        leaves = np.empty(len(X), dtype=np.intp)
+        rows = np.arange(len(X))
+        nodes = np.zeros(len(X), dtype=np.intp)
+        while rows.size:
+            left = self.children_left[nodes]
+            at_leaf = left == TREE_LEAF
+            if at_leaf.any():
+                leaves[rows[at_leaf]] = nodes[at_leaf]
+                inner = ~at_leaf
+                rows, nodes, left = rows[inner], nodes[inner], left[inner]
+            go_left = X[rows, self.feature[nodes]] <= self.threshold[nodes]
+            nodes = np.where(go_left, left, self.children_right[nodes])
+        return leaves
+
+    def _apply_rows(self, X):
+        feature, threshold = self.feature.item, self.threshold.item
+        children_left, children_right = self.children_left.item, self.children_right.item
+        leaves = []
+        # tolist turns the float32 values into exactly equal Python floats
+        for row in X.tolist():
+            node = 0
+            left = children_left(0)
+            while left != TREE_LEAF:
+                node = left if row[feature(node)] <= threshold(node) else children_right(node)
+                left = children_left(node)
+            leaves.append(node)
+        return np.array(leaves, dtype=np.intp)
+
+    def predict(self, X):
+        """Predict the class of each row of X."""
+        return self.classes.take(self.leaf_class[self.apply(X)])
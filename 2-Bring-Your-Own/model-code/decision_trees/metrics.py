@@ -0,0 +1,187 @@
+# Lightweight metrics for the inference server. They have no dependencies beyond the standard library so
+# they can be used from predictor.py without adding anything to the container image.
+#
+# Each gunicorn worker keeps its own Registry of counters and histograms and regularly writes a snapshot of it
+# to a file in a directory shared by all workers. The /metrics route merges the snapshots of every worker,
+# including ones that have exited, and renders them in the Prometheus text format.
+
+import bisect
+import glob
+import json
+import os
+import threading
+import time
+
+
+class Counter(object):
+    """A value that only goes up, such as a number of requests."""
+
+    kind = 'counter'
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def state(self):
+        return {'value': self.value}
+
+    @staticmethod
+    def merge(states):
+        return {'value': sum(state['value'] for state in states)}
+
+    @staticmethod
+    def samples(name, labels, state):
+        yield name, labels, state['value']
+
+
+class Histogram(object):
+    """Counts observations into buckets by upper bound, like a Prometheus histogram. counts[i] is the number
+    of observations <= bounds[i] and > bounds[i - 1]; the last entry counts everything above the largest bound."""
+
+    kind = 'histogram'
+
+    def __init__(self, bounds):
+        self.bounds = sorted(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self.counts[bisect.bisect_left(self.bounds, value)] += 1
+            self.count += 1
+            self.sum += value
+
+    def summary(self):
+        """Return a short one line description, e.g. 'n=12 mean=3.5 <=1:4 <=2:0 ... >64:1'."""
+        mean = float(self.sum) / self.count if self.count else 0.0
+        buckets = ['<={}:{}'.format(bound, count) for bound, count in zip(self.bounds, self.counts)]
+        buckets.append('>{}:{}'.format(self.bounds[-1], self.counts[-1]))
+        return 'n={} mean={:.2f} {}'.format(self.count, mean, ' '.join(buckets))
+
+    def state(self):
+        return {'bounds': self.bounds, 'counts': list(self.counts), 'count': self.count, 'sum': self.sum}
+
+    @staticmethod
+    def merge(states):
+        merged = {'bounds': states[0]['bounds'], 'counts': [0] * len(states[0]['counts']), 'count': 0, 'sum': 0}
+        for state in states:
+            if state['bounds'] != merged['bounds']:
+                continue
+            merged['counts'] = [a + b for a, b in zip(merged['counts'], state['counts'])]
+            merged['count'] += state['count']
+            merged['sum'] += state['sum']
+        return merged
+
+    @staticmethod
+    def samples(name, labels, state):
+        cumulative = 0
+        for bound, count in zip(state['bounds'], state['counts']):
+            cumulative += count
+            yield name + '_bucket', labels + [('le', repr(float(bound)))], cumulative
+        yield name + '_bucket', labels + [('le', '+Inf')], state['count']
+        yield name + '_sum', labels, state['sum']
+        yield name + '_count', labels, state['count']
+
+
+_kinds = dict((kind.kind, kind) for kind in (Counter, Histogram))
+
+
+class Registry(object):
+    """The metrics of one process, which are shared with the other workers through snapshot files in directory.
+
+    Args:
+        directory: where the workers write their snapshots.
+        flush_interval: the least number of seconds between two snapshots written by maybe_flush.
+    """
+
+    def __init__(self, directory, flush_interval=1.0):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._metrics = []
+        self._help = {}
+        self._last_flush = 0
+        self._pid = None
+        self._path = None
+        self._flush_lock = threading.Lock()
+
+    def add(self, name, help, metric, **labels):
+        """Register an existing metric under name with the given labels and return it."""
+        self._help[name] = (metric.kind, help)
+        self._metrics.append((name, sorted(labels.items()), metric))
+        return metric
+
+    def counter(self, name, help, **labels):
+        return self.add(name, help, Counter(), **labels)
+
+    def histogram(self, name, help, bounds, **labels):
+        return self.add(name, help, Histogram(bounds), **labels)
+
+    def snapshot(self):
+        return {'help': self._help,
+                'metrics': [{'name': name, 'labels': labels, 'kind': metric.kind, 'state': metric.state()}
+                            for name, labels, metric in self._metrics]}
+
+    def flush(self):
+        """Write this process's snapshot, replacing its previous one atomically."""
+        # Threads of a worker share the temporary file, so only one of them writes at a time
+        with self._flush_lock:
+            if self._pid != os.getpid():
+                # First flush in this process (or in a worker forked after the registry was created)
+                self._pid = os.getpid()
+                self._path = os.path.join(self.directory, '{}-{}.json'.format(self._pid, int(time.time() * 1000)))
+                if not os.path.isdir(self.directory):
+                    os.makedirs(self.directory)
+            temp_path = self._path + '.tmp'
+            with open(temp_path, 'w') as out:
+                json.dump(self.snapshot(), out)
+            os.rename(temp_path, self._path)
+            self._last_flush = time.time()
+
+    def maybe_flush(self):
+        """Flush if the last snapshot is older than flush_interval."""
+        if time.time() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def collect(self):
+        """Merge the snapshots of all processes and return them as Prometheus text."""
+        self.flush()
+        help = {}
+        merged = {}
+        for path in sorted(glob.glob(os.path.join(self.directory, '*.json'))):
+            try:
+                with open(path, 'r') as inp:
+                    snapshot = json.load(inp)
+            except (IOError, OSError, ValueError):
+                continue
+            help.update(snapshot['help'])
+            for metric in snapshot['metrics']:
+                key = (metric['name'], tuple(tuple(label) for label in metric['labels']))
+                merged.setdefault(key, (metric['kind'], []))[1].append(metric['state'])
+
+        lines = []
+        for name in sorted(help):
+            kind, text = help[name]
+            lines.append('# HELP {} {}'.format(name, text))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for (metric_name, labels), (metric_kind, states) in sorted(merged.items()):
+                if metric_name != name:
+                    continue
+                metric_type = _kinds[metric_kind]
+                for sample, sample_labels, value in metric_type.samples(name, list(labels), metric_type.merge(states)):
+                    lines.append('{}{} {}'.format(sample, _format_labels(sample_labels), _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, value) for name, value in labels) + '}'
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
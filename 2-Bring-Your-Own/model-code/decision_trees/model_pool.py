@@ -0,0 +1,102 @@
+# A pool of models for serving many small models from one endpoint. Models are loaded the first time a
+# request names them and kept until the pool needs room: when the models held exceed the memory budget, the
+# least recently used ones are dropped and will be loaded again on their next request.
+#
+# Concurrent requests for a model that is not loaded yet share a single load. Each gunicorn worker has its
+# own pool.
+
+from __future__ import print_function
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import Counter, Histogram
+
+
+def directory_size(path):
+    """Return the size in bytes of the file or directory tree at path."""
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+class _Load(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.entry = None
+        self.error = None
+
+
+class ModelPool(object):
+    """Loads models by name on demand and evicts the least recently used ones beyond a memory budget.
+
+    Args:
+        load_fn: function that takes a model name and returns the loaded model.
+        size_fn: function that takes a model name and returns the memory the model is expected to take,
+            the size of its artifact is a good enough estimate for decision trees.
+        memory_budget: the total size of the models to keep loaded, in the unit of size_fn. The model
+            being used is never evicted, even if it alone is over the budget.
+    """
+
+    def __init__(self, load_fn, size_fn, memory_budget):
+        self.load_fn = load_fn
+        self.size_fn = size_fn
+        self.memory_budget = memory_budget
+        self.loads = Counter()
+        self.evictions = Counter()
+        self.load_seconds = Histogram([0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30])
+        self._models = OrderedDict()
+        self._loading = {}
+        self._loaded = 0
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        """Return (model, version) for the named model, loading it if needed. version identifies this load
+        of the model, so it changes if the model is evicted and loaded again."""
+        with self._lock:
+            entry = self._models.pop(name, None)
+            if entry is not None:
+                self._models[name] = entry
+                return entry[0], entry[1]
+            load = self._loading.get(name)
+            leader = load is None
+            if leader:
+                load = self._loading[name] = _Load()
+
+        if not leader:
+            load.done.wait()
+            if load.error is not None:
+                raise load.error
+            return load.entry[0], load.entry[1]
+
+        try:
+            start = time.time()
+            model = self.load_fn(name)
+            size = self.size_fn(name)
+            self.load_seconds.observe(time.time() - start)
+            self.loads.inc()
+            with self._lock:
+                self._loaded += 1
+                load.entry = (model, (name, self._loaded), size)
+                self._models[name] = load.entry
+                self._size += size
+                self._evict()
+            return load.entry[0], load.entry[1]
+        except Exception as e:
+            load.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._loading[name]
+            load.done.set()
+
+    def _evict(self):
+        # Called with the lock held, right after the newest model was added at the end
+        while self._size > self.memory_budget and len(self._models) > 1:
+            name, entry = self._models.popitem(last=False)
+            self._size -= entry[2]
+            self.evictions.inc()
+            print('Evicted model {} ({} bytes) from the model pool'.format(name, entry[2]))
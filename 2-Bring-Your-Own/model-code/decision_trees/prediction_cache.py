@@ -0,0 +1,93 @@
+# A bounded cache of predictions keyed by the raw bytes of each feature row. Clients that resend the same
+# rows (retries, repeated lookups) get those rows answered from the cache, and only the rows that miss are
+# passed to the model, in a single call.
+#
+# Every entry belongs to the model version that made it and only a request to the same version can hit it,
+# so a prediction is never served for a model other than the one that made it, and entries of models that
+# are no longer loaded just age out. Each gunicorn worker has its own cache.
+
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from metrics import Counter
+
+
+class PredictionCache(object):
+    """An LRU cache of per-row predictions with an optional time to live.
+
+    Args:
+        max_entries: the number of rows to remember, the least recently used ones are dropped beyond that.
+        ttl_seconds: how long a prediction stays valid, 0 to keep it until it is evicted.
+    """
+
+    def __init__(self, max_entries, ttl_seconds=0):
+        self.max_entries = max_entries
+        self.ttl = ttl_seconds
+        self.hits = Counter()
+        self.misses = Counter()
+        self.saved_seconds = Counter()
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # Running cost of a model call per row, to estimate the time the hits saved
+        self._predict_seconds = 0.0
+        self._predict_rows = 0
+
+    def predict(self, data, version, predict_fn):
+        """Return predict_fn(data), taking the rows already predicted by this model version (any hashable
+        value that identifies the loaded model) from the cache and calling predict_fn once with the rows
+        that are not. Input that can't be viewed as numbers is passed straight to predict_fn."""
+        try:
+            rows = np.ascontiguousarray(data, dtype=np.float64)
+        except (TypeError, ValueError):
+            return predict_fn(data)
+        if rows.ndim != 2 or not len(rows):
+            return predict_fn(data)
+        # Every row as one opaque value, so its bytes can be taken without a per-row slice and reshape
+        keys = rows.view(np.dtype((np.void, rows.dtype.itemsize * rows.shape[1]))).ravel()
+        keys = [(version, key.tobytes()) for key in keys]
+
+        now = time.time()
+        found = [None] * len(keys)
+        missing = []
+        with self._lock:
+            for i, key in enumerate(keys):
+                entry = self._entries.pop(key, None)
+                if entry is not None and (not self.ttl or entry[1] > now):
+                    # Put it back at the end, which is the most recently used
+                    self._entries[key] = entry
+                    found[i] = entry[0]
+                else:
+                    missing.append(i)
+        self.hits.inc(len(keys) - len(missing))
+        self.misses.inc(len(missing))
+
+        if not missing:
+            self._record_saved(len(keys))
+            return np.array(found)
+
+        start = time.time()
+        predicted = predict_fn(data if len(missing) == len(keys) else rows[missing])
+        elapsed = time.time() - start
+        self._record_saved(len(keys) - len(missing))
+        self._predict_seconds += elapsed
+        self._predict_rows += len(missing)
+
+        result = np.empty(len(keys), dtype=predicted.dtype)
+        result[missing] = predicted
+        expires = now + self.ttl
+        with self._lock:
+            for i, value in zip(missing, predicted):
+                self._entries[keys[i]] = (value, expires)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        for i, value in enumerate(found):
+            if value is not None:
+                result[i] = value
+        return result
+
+    def _record_saved(self, hits):
+        if hits and self._predict_rows:
+            self.saved_seconds.inc(hits * self._predict_seconds / self._predict_rows)
@@ -4,83 +4,656 @@
 from __future__ import print_function
 
 import os
+import gc
+import hashlib
+import io
+import itertools
 import json
 import pickle
 import StringIO
 import sys
 import signal
+import threading
+import time
 import traceback
+from contextlib import contextmanager
+
+from collections import OrderedDict
 
 import flask
 
+import numpy as np
 import pandas as pd
+from numpy.lib import format as npy_format
+
+import recordio
+from batching import MicroBatcher
+from metrics import Registry
+from model_pool import ModelPool, directory_size
+from prediction_cache import PredictionCache
+import flat_tree
+from flat_tree import FlatTree
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+try:
+    import gevent.monkey
+except ImportError:
+    gevent = None
 
 prefix = '/opt/ml/'
 model_path = os.path.join(prefix, 'model')
 
+# The decoder used for text/csv requests. 'pandas' accepts any CSV, including string label columns.
+# 'numpy' only accepts purely numeric CSV but parses the request body straight into a float64 array,
+# which avoids most of the per-request overhead for small batches.
+csv_decoder = os.environ.get('MODEL_SERVER_CSV_DECODER', 'pandas')
+
+# Micro-batching coalesces the rows of concurrent requests in a worker into one predict call. It is off
+# unless MODEL_SERVER_BATCH_MAX_ROWS is set, and only helps with gevent or threaded workers, since a sync
+# worker serves one request at a time.
+batch_max_rows = int(os.environ.get('MODEL_SERVER_BATCH_MAX_ROWS', 0))
+batch_max_wait_ms = float(os.environ.get('MODEL_SERVER_BATCH_MAX_WAIT_MS', 5))
+
+# The inference engine for pickled models. 'sklearn' calls the classifier's own predict. 'flat' exports the
+# fitted tree into flat node arrays when the model is loaded and evaluates them with NumPy, which skips
+# scikit-learn's per-call overhead and is much faster for a handful of rows, but slower on large batches.
+# 'auto' uses the flat engine for small batches and scikit-learn for the rest. Both give identical predictions.
+# Models saved as a memory-mapped bundle always use 'flat'.
+engine = os.environ.get('MODEL_SERVER_ENGINE', 'sklearn')
+if engine not in ('sklearn', 'flat', 'auto'):
+    raise ValueError('MODEL_SERVER_ENGINE must be sklearn, flat or auto, got {!r}'.format(engine))
+
+# CSV requests answered with CSV are read, predicted and answered in chunks of this many rows when it is
+# positive, so a worker's memory use does not grow with the size of a batch transform payload
+stream_chunk_rows = int(os.environ.get('MODEL_SERVER_STREAM_CHUNK_ROWS', 0))
+
+# Number of rows whose predictions each worker caches, 0 disables the cache, and how long they stay valid
+cache_entries = int(os.environ.get('MODEL_SERVER_CACHE_ENTRIES', 0))
+cache_ttl_seconds = float(os.environ.get('MODEL_SERVER_CACHE_TTL_SECONDS', 0))
+
+# With multi-model hosting, requests name the model to use in the target model header, as a path relative to
+# model_path, and each worker keeps up to the memory budget of them loaded
+multi_model = os.environ.get('MODEL_SERVER_MULTI_MODEL', 'false').lower() == 'true'
+model_pool_mb = float(os.environ.get('MODEL_SERVER_MODEL_POOL_MB', 1024))
+
+TARGET_MODEL_HEADER = 'X-Amzn-SageMaker-Target-Model'
+
+# Seconds between checks for a new model artifact in model_path, 0 never reloads the model
+reload_interval = float(os.environ.get('MODEL_SERVER_RELOAD_INTERVAL', 0))
+
+# Where the workers share their metrics snapshots for /metrics. serve empties it when the server starts.
+metrics_dir = os.environ.get('MODEL_SERVER_METRICS_DIR', '/tmp/model-server-metrics')
+
+# Set by serve when gunicorn imports this module in its master process before forking the workers
+preload = os.environ.get('MODEL_SERVER_PRELOAD', 'false').lower() == 'true'
+
 # A singleton for holding the model. This simply loads the model and holds it.
 # It has a predict function that does a prediction based on the model and the input data.
 
 class ScoringService(object):
     model = None                # Where we keep the model when it's loaded
+    version = 0                 # Counts the models loaded, so cached predictions can be tied to one
+    fingerprint = None          # The artifact's file times and sizes when the model was loaded, for reloads
+    checksum = None             # and a hash of its content
+    last_check = 0
+    reloading = False
+    # Guards the test and set of last_check and reloading, so concurrent requests start one reload at most
+    reload_lock = threading.Lock()
 
     @classmethod
     def get_model(cls):
         """Get the model object for this instance, loading it if it's not already loaded."""
         if cls.model == None:
-            with open(os.path.join(model_path, 'decision-tree-model.pkl'), 'r') as inp:
-                cls.model = pickle.load(inp)
+            if reload_interval > 0:
+                # Taken before loading, so an artifact replaced during the load is picked up by the next check
+                cls.fingerprint, cls.checksum = cls.artifact_fingerprint(), cls.artifact_checksum()
+                cls.last_check = time.time()
+            cls.model = cls.load_model()
+            cls.version += 1
+        elif reload_interval > 0:
+            cls.check_for_update()
         return cls.model
 
     @classmethod
-    def predict(cls, input):
+    def artifact_files(cls, path=None):
+        path = path or model_path
+        bundle = os.path.join(path, 'decision-tree-model')
+        if os.path.isdir(bundle):
+            return sorted(os.path.join(bundle, name) for name in os.listdir(bundle))
+        return [os.path.join(path, 'decision-tree-model.pkl')]
+
+    @classmethod
+    def artifact_fingerprint(cls, path=None):
+        """Return the modification time and size of each file of the artifact in path, None if there is none."""
+        try:
+            return tuple((name, os.path.getmtime(name), os.path.getsize(name)) for name in cls.artifact_files(path))
+        except OSError:
+            return None
+
+    @classmethod
+    def artifact_checksum(cls, path=None):
+        """Return an MD5 hash of the content of the artifact in path, None if it can't be read."""
+        digest = hashlib.md5()
+        try:
+            for name in cls.artifact_files(path):
+                with open(name, 'rb') as inp:
+                    for block in iter(lambda: inp.read(1 << 20), b''):
+                        digest.update(block)
+        except (IOError, OSError):
+            return None
+        return digest.hexdigest()
+
+    @classmethod
+    def check_for_update(cls):
+        """At most every reload_interval seconds, check whether the artifact in model_path changed since the
+        model was loaded and if so, start loading it in the background. Requests keep using the current model
+        until the new one is ready."""
+        now = time.time()
+        # Cheap unlocked check first, as this runs on every request
+        if cls.reloading or now - cls.last_check < reload_interval:
+            return
+        with cls.reload_lock:
+            if cls.reloading or now - cls.last_check < reload_interval:
+                return
+            cls.last_check = now
+            fingerprint = cls.artifact_fingerprint()
+            if fingerprint is None or fingerprint == cls.fingerprint:
+                return
+            cls.reloading = True
+        loader = threading.Thread(target=cls.reload, args=(fingerprint,))
+        loader.daemon = True
+        loader.start()
+
+    @classmethod
+    def reload(cls, fingerprint):
+        """Load the artifact in model_path and swap it in, unless its content is unchanged. If the new model
+        can't be loaded, the current one stays in use until the artifact changes again."""
+        def load():
+            checksum = cls.artifact_checksum()
+            return checksum, cls.load_model() if checksum != cls.checksum else None
+        try:
+            start = time.time()
+            checksum, model = run_in_native_thread(load)
+            if model is not None:
+                # predict reads the version before the model, so assigning them in the opposite order means a
+                # request can never pair the new version with the old model in the prediction cache
+                cls.model = model
+                cls.version += 1
+                cls.checksum = checksum
+                reload_seconds.observe(time.time() - start)
+                print('Reloaded the model from {} in {:.3f} seconds'.format(model_path, time.time() - start))
+        except Exception:
+            reload_failures.inc()
+            print('Failed to reload the model, keeping the current one')
+            traceback.print_exc()
+        finally:
+            cls.fingerprint = fingerprint
+            cls.reloading = False
+
+    @classmethod
+    def has_model(cls, path=None):
+        """Whether the directory at path holds a model artifact."""
+        path = path or model_path
+        return (os.path.isdir(os.path.join(path, 'decision-tree-model')) or
+                os.path.isfile(os.path.join(path, 'decision-tree-model.pkl')))
+
+    @classmethod
+    def load_model(cls, path=None):
+        """Load the model from the directory at path and check that it can make a prediction. Raises if it
+        can't, so that a broken model is caught at start up rather than on the first request.
+
+        If training saved the tree as a memory-mappable bundle (model_format=mmap), the bundle is mapped
+        read-only instead of unpickling the model, so every worker shares the same pages."""
+        path = path or model_path
+        bundle = os.path.join(path, 'decision-tree-model')
+        if os.path.isdir(bundle):
+            model = FlatTree.load(bundle)
+        else:
+            with open(os.path.join(path, 'decision-tree-model.pkl'), 'rb') as inp:
+                model = pickle.load(inp)
+            if engine == 'flat':
+                model = cls.export_flat(model)
+            elif engine == 'auto':
+                model = AutoEngine(model, cls.export_flat(model))
+        n_features = getattr(model, 'n_features_', getattr(model, 'n_features_in_', None))
+        if n_features is not None:
+            model.predict(np.zeros((1, n_features)))
+        elif not callable(getattr(model, 'predict', None)):
+            raise ValueError('The loaded model has no predict method')
+        return model
+
+    @classmethod
+    def export_flat(cls, clf, probe_rows=1000):
+        """Export a fitted decision tree for the flat engine, and check that it predicts exactly like the
+        original on probe rows built from the tree's own split thresholds, so that they exercise every
+        branch, including values that fall exactly on a threshold."""
+        if not hasattr(clf, 'tree_'):
+            raise ValueError('MODEL_SERVER_ENGINE=flat only supports decision trees, got {}'.format(type(clf).__name__))
+        flat = FlatTree.from_estimator(clf)
+        rng = np.random.RandomState(0)
+        probe = rng.standard_normal((probe_rows, flat.n_features_))
+        splits = flat.feature >= 0
+        for column in range(flat.n_features_):
+            thresholds = flat.threshold[splits & (flat.feature == column)]
+            if len(thresholds):
+                probe[:, column] = rng.choice(thresholds, probe_rows) + rng.choice([-1e-6, 0, 1e-6], probe_rows)
+        if not np.array_equal(clf.predict(probe), flat.predict(probe)):
+            raise ValueError('The flat engine does not reproduce the model\'s predictions')
+        return flat
+
+    @classmethod
+    def predict(cls, input, target=None):
         """For the input, do the predictions and return them.
 
         Args:
             input (a pandas dataframe): The data on which to do the predictions. There will be
-                one prediction per row in the dataframe"""
-        clf = cls.get_model()
+                one prediction per row in the dataframe
+            target (str): The model to use from the model pool, or None for the model in model_path"""
+        if target is None:
+            version = cls.version
+            clf = cls.get_model()
+        else:
+            clf, version = pool.get(target)
+        if cache is not None:
+            return cache.predict(input, version, clf.predict)
         return clf.predict(input)
 
+def run_in_native_thread(fn):
+    """Call fn and return its result. Under gevent workers threading is monkey patched, so the background
+    thread that reloads the model is a greenlet, and loading a model never yields: every request of the worker
+    would wait for the whole load. There fn runs in a thread of gevent's native thread pool instead, which
+    shares the GIL with the requests but lets them run, while the calling greenlet waits for the result."""
+    if gevent is not None and gevent.monkey.is_module_patched('threading'):
+        return gevent.get_hub().threadpool.apply(fn)
+    return fn()
+
+class AutoEngine(object):
+    """Predicts small batches with the flat engine and larger ones with the scikit-learn model it was
+    exported from, using whichever is faster for the batch size."""
+
+    def __init__(self, clf, flat):
+        self.clf = clf
+        self.flat = flat
+        self.n_features_ = flat.n_features_
+
+    def predict(self, input):
+        if len(input) <= flat_tree.SCALAR_ROWS:
+            return self.flat.predict(input)
+        return self.clf.predict(input)
+
+pool = ModelPool(lambda name: ScoringService.load_model(os.path.join(model_path, name)),
+                 lambda name: directory_size(os.path.join(model_path, name)),
+                 model_pool_mb * 1024 * 1024) if multi_model else None
+
+cache = PredictionCache(cache_entries, cache_ttl_seconds) if cache_entries > 0 else None
+
+batcher = MicroBatcher(ScoringService.predict, batch_max_rows, batch_max_wait_ms) if batch_max_rows > 0 else None
+
+# Metrics for /metrics. Every request records how long each stage took: reading the body, decoding it,
+# predicting and encoding the response.
+registry = Registry(metrics_dir)
+
+latency_buckets = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+stage_seconds = dict((stage, registry.histogram('model_server_stage_seconds',
+                                                'Time spent in each stage of /invocations requests.',
+                                                latency_buckets, stage=stage))
+                     for stage in ('read', 'decode', 'predict', 'encode'))
+request_seconds = registry.histogram('model_server_request_seconds',
+                                     'Time spent on successful /invocations requests.', latency_buckets)
+request_rows = registry.histogram('model_server_request_rows', 'Number of records per /invocations request.',
+                                  [1, 10, 100, 1000, 10000, 100000])
+request_counts = {}
+
+if cache is not None:
+    registry.add('model_server_cache_hits_total', 'Number of rows answered from the prediction cache.', cache.hits)
+    registry.add('model_server_cache_misses_total', 'Number of rows passed on to the model.', cache.misses)
+    registry.add('model_server_cache_saved_seconds_total',
+                 'Estimated model time saved by cache hits, at the average cost per row of the misses.',
+                 cache.saved_seconds)
+
+reload_seconds = registry.histogram('model_server_model_reload_seconds',
+                                    'Time taken to load a changed model artifact and swap it in.',
+                                    [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30])
+reload_failures = registry.counter('model_server_model_reload_failures_total',
+                                   'Number of changed model artifacts that could not be loaded.')
+
+if pool is not None:
+    registry.add('model_server_model_loads_total', 'Number of models loaded into the model pool.', pool.loads)
+    registry.add('model_server_model_evictions_total', 'Number of models evicted from the model pool.', pool.evictions)
+    registry.add('model_server_model_load_seconds', 'Time taken to load a model into the model pool.', pool.load_seconds)
+
+if batcher is not None:
+    registry.add('model_server_batch_rows', 'Number of rows per micro-batch.', batcher.batch_rows)
+    registry.add('model_server_batch_requests', 'Number of requests per micro-batch.', batcher.batch_requests)
+
+if preload and (not multi_model or ScoringService.has_model()):
+    ScoringService.get_model()
+    # Move everything allocated so far out of the collector's reach, so that garbage collection in the
+    # workers does not write to (and so copy) the pages they share with the master. Python 3.7+ only.
+    if hasattr(gc, 'freeze'):
+        gc.freeze()
+
+def decode_csv_pandas(body):
+    """Parse a CSV request body into a pandas dataframe."""
+    return pd.read_csv(StringIO.StringIO(body.decode('utf-8')), header=None)
+
+def decode_csv_numpy(body):
+    """Parse a purely numeric CSV request body into a contiguous float64 array of shape (rows, columns).
+
+    The body is handed to numpy's C parser in one call, so no per-row Python objects are created.
+    Raises ValueError if the body is empty, is not numeric or does not have the same number of
+    columns on every row."""
+    body = body.strip()
+    if not body:
+        raise ValueError('Empty CSV payload')
+    if b'\r' in body:
+        body = body.replace(b'\r\n', b'\n')
+    rows = body.count(b'\n') + 1
+    first_line = body.split(b'\n', 1)[0]
+    columns = first_line.count(b',') + 1
+    # Count the commas of every line, by locating the line ends among the comma positions, so that ragged rows
+    # are caught even when their total number of values happens to fill the matrix
+    chars = np.frombuffer(body, dtype=np.uint8)
+    commas = np.flatnonzero(chars == ord(','))
+    line_ends = np.append(np.flatnonzero(chars == ord('\n')), len(chars))
+    if (np.diff(np.concatenate(([0], np.searchsorted(commas, line_ends)))) != columns - 1).any():
+        raise ValueError('CSV payload does not have {} columns on every row'.format(columns))
+    values = np.fromstring(body.replace(b'\n', b','), dtype=np.float64, sep=',')
+    if values.size != rows * columns:
+        raise ValueError('CSV payload contains non-numeric values')
+    return values.reshape(rows, columns)
+
+csv_decoders = {
+    'pandas': decode_csv_pandas,
+    'numpy': decode_csv_numpy,
+}
+
+if csv_decoder not in csv_decoders:
+    raise ValueError('MODEL_SERVER_CSV_DECODER must be one of {}, got {!r}'.format(sorted(csv_decoders), csv_decoder))
+
+# Request decoders, keyed by content type. A decoder takes the raw request body and returns a 2-D array
+# or dataframe of features with one row per record. Use register_decoder to support more content types.
+decoders = {}
+
+def register_decoder(content_type):
+    """Decorator that registers a request decoder for content_type."""
+    def register(decoder):
+        decoders[content_type] = decoder
+        return decoder
+    return register
+
+@register_decoder('text/csv')
+def decode_csv(body):
+    """Decode CSV with the configured decoder and drop the first column, since the sample notebook
+    uses training data (label first) to show case predictions. For numpy input the drop is a view,
+    so the parsed values are not copied again."""
+    data = csv_decoders[csv_decoder](body)
+    if isinstance(data, np.ndarray):
+        return data[:, 1:]
+    data.drop(data.columns[[0]],axis=1,inplace=True)
+    return data
+
+# Largest .npy header we read, the format pads headers to a multiple of 64 bytes and they are tiny in practice
+NPY_HEADER_MAX = 65536
+
+@register_decoder('application/x-npy')
+def decode_npy(body):
+    """Decode a .npy array of features. The array is a read-only view over the request body."""
+    header = io.BytesIO(body[:NPY_HEADER_MAX])
+    version = npy_format.read_magic(header)
+    if version == (1, 0):
+        shape, fortran_order, dtype = npy_format.read_array_header_1_0(header)
+    elif version == (2, 0):
+        shape, fortran_order, dtype = npy_format.read_array_header_2_0(header)
+    else:
+        raise ValueError('Unsupported .npy format version {}'.format(version))
+    if dtype.hasobject:
+        raise ValueError('.npy payloads with object arrays are not supported')
+    count = int(np.prod(shape, dtype=np.int64))
+    data = np.frombuffer(body, dtype=dtype, count=count, offset=header.tell())
+    data = data.reshape(shape, order='F' if fortran_order else 'C')
+    if data.ndim == 1:
+        data = data.reshape(1, -1)
+    if data.ndim != 2:
+        raise ValueError('.npy payload must be a 1-D or 2-D array, got shape {}'.format(shape))
+    return data
+
+@register_decoder('application/x-recordio-protobuf')
+def decode_recordio(body):
+    """Decode SageMaker RecordIO-protobuf dense tensors, one record per row."""
+    return recordio.decode(body)
+
+# Arrow IPC streams are only accepted when pyarrow is installed in the image
+if pa is not None:
+    @register_decoder('application/vnd.apache.arrow.stream')
+    def decode_arrow(body):
+        """Decode an Arrow IPC stream with one numeric column per feature. The columns are read in place
+        from the request body and only copied when they are stacked into one matrix."""
+        table = pa.ipc.open_stream(pa.py_buffer(body)).read_all()
+        return np.column_stack([column.to_numpy() for column in table.columns])
+
+# Response encoders write the predictions into a buffer for the content type named in the Accept header.
+# The buffers are kept in a pool shared by the whole worker and handed out to one request at a time, so a
+# worker holds as many buffers as it has ever served requests at once. A per-thread buffer would not do:
+# under gevent every request runs in a new greenlet and would never find a buffer to reuse.
+
+text_type = type(u'')
+
+_free_buffers = []
+_free_buffers_lock = threading.Lock()
+
+@contextmanager
+def output_buffer():
+    """Lend an empty output buffer from the worker's pool for the duration of the with block. Take what
+    was written with getvalue inside the block, the buffer is reused by other requests afterwards."""
+    with _free_buffers_lock:
+        buf = _free_buffers.pop() if _free_buffers else io.BytesIO()
+    buf.seek(0)
+    buf.truncate()
+    try:
+        yield buf
+    finally:
+        with _free_buffers_lock:
+            _free_buffers.append(buf)
+
+def encode_csv(predictions, buf):
+    """Write one prediction per line. Floats use repr so that they round trip exactly."""
+    values = predictions.tolist()
+    kind = predictions.dtype.kind
+    if kind == 'f':
+        text = '\n'.join(map(repr, values))
+    elif kind in 'biu':
+        text = '\n'.join(map(str, values))
+    else:
+        text = u'\n'.join(map(text_type, values))
+    buf.write(text.encode('utf-8'))
+    buf.write(b'\n')
+
+def encode_json(predictions, buf):
+    """Write the predictions as {"predictions": [...]}."""
+    buf.write(json.dumps({'predictions': predictions.tolist()}).encode('utf-8'))
+
+def encode_npy(predictions, buf):
+    """Write the predictions in NumPy's .npy format. String labels are stored as a unicode array so
+    that clients can load the result without allow_pickle."""
+    if predictions.dtype.kind == 'O':
+        predictions = predictions.astype(text_type)
+    np.save(buf, predictions, allow_pickle=False)
+
+# The first entry is the default for requests without an Accept header or with Accept: */*
+encoders = OrderedDict([
+    ('text/csv', encode_csv),
+    ('application/json', encode_json),
+    ('application/x-npy', encode_npy),
+])
+
+def read_csv_chunks(stream, chunk_rows, block_size=1 << 16):
+    """Yield the CSV request body in stream as byte strings of complete lines, each one roughly chunk_rows
+    lines long (up to one block_size read more). The body is read in blocks rather than line by line, and
+    no more than a chunk of it is held at a time."""
+    blocks = []
+    lines = 0
+    while True:
+        block = stream.read(block_size)
+        if block:
+            blocks.append(block)
+            lines += block.count(b'\n')
+            if lines < chunk_rows:
+                continue
+            pending = b''.join(blocks)
+            end = pending.rindex(b'\n') + 1
+            chunk, rest = pending[:end], pending[end:]
+            blocks = [rest] if rest else []
+            lines = 0
+        else:
+            chunk = b''.join(blocks)
+        if chunk.strip():
+            yield chunk
+        if not block:
+            return
+
+def predict_csv_chunks(chunks, target=None):
+    """Decode, predict and encode each chunk of CSV rows in turn, yielding the CSV predictions of each one."""
+    rows = 0
+    for chunk in chunks:
+        data = decode_csv(chunk)
+        rows += data.shape[0]
+        predictions = ScoringService.predict(data, target)
+        with output_buffer() as out:
+            encode_csv(predictions, out)
+            result = out.getvalue()
+        yield result
+    if rows:
+        print('Streamed {} records'.format(rows))
+        request_rows.observe(rows)
+
 # The flask app for serving predictions
 app = flask.Flask(__name__)
 
 @app.route('/ping', methods=['GET'])
 def ping():
     """Determine if the container is working and healthy. In this sample container, we declare
-    it healthy if we can load the model successfully."""
-    health = ScoringService.get_model() is not None  # You can insert a health check here
+    it healthy if we can load the model successfully. With a preloaded model this is already the case
+    before the workers start, otherwise the first ping loads and validates the model. With multi-model
+    hosting, the models are only loaded when they are requested, so a model_path without a model of its
+    own is healthy as long as it exists."""
+    if multi_model and not ScoringService.has_model():
+        health = os.path.isdir(model_path)
+    else:
+        health = ScoringService.get_model() is not None  # You can insert a health check here
 
     status = 200 if health else 404
     return flask.Response(response='\n', status=status, mimetype='application/json')
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Report the metrics of all workers in the Prometheus text format."""
+    return flask.Response(response=registry.collect(), status=200, content_type='text/plain; version=0.0.4')
+
+@app.after_request
+def record_request(response):
+    """Count /invocations responses by status code and share this worker's metrics with the others."""
+    if flask.request.path == '/invocations':
+        counter = request_counts.get(response.status_code)
+        if counter is None:
+            counter = request_counts[response.status_code] = registry.counter(
+                'model_server_requests_total', 'Number of /invocations requests by response status.',
+                status=response.status_code)
+        counter.inc()
+        registry.maybe_flush()
+    return response
+
 @app.route('/invocations', methods=['POST'])
 def transformation():
-    """Do an inference on a single batch of data. In this sample server, we take data as CSV, convert
-    it to a pandas data frame for internal use and then convert the predictions back to CSV (which really
-    just means one prediction per line, since there's a single column.
+    """Do an inference on a single batch of data. In this sample server, we take data as CSV (or one of
+    the binary formats in decoders), convert it to a pandas data frame or numpy array for internal use and
+    then convert the predictions back to CSV (which really just means one prediction per line, since
+    there's a single column), JSON or .npy, depending on the Accept header.
     """
     data = None
 
-    # Convert from CSV to pandas
-    if flask.request.content_type == 'text/csv':
-        data = flask.request.data.decode('utf-8')
-        s = StringIO.StringIO(data)
-        data = pd.read_csv(s, header=None)
+    # Pick the response format before doing any work, so unsupported Accept headers fail fast
+    if flask.request.accept_mimetypes:
+        accept = flask.request.accept_mimetypes.best_match(list(encoders))
+        if accept is None:
+            return flask.Response(response='This predictor can only return {}'.format(', '.join(encoders)),
+                                  status=406, mimetype='text/plain')
     else:
-        return flask.Response(response='This predictor only supports CSV data', status=415, mimetype='text/plain')
+        accept = next(iter(encoders))
+
+    # Convert the request body to a pandas dataframe or numpy array with the decoder for its content type
+    decoder = decoders.get(flask.request.mimetype)
+    if decoder is None:
+        return flask.Response(response='This predictor only supports {}'.format(', '.join(sorted(decoders))),
+                              status=415, mimetype='text/plain')
+
+    # Use the model in model_path, unless the request names one of the models under it
+    target = flask.request.headers.get(TARGET_MODEL_HEADER)
+    if target is not None:
+        if pool is None:
+            return flask.Response(response='Multi-model hosting is not enabled', status=400, mimetype='text/plain')
+        target = os.path.normpath(target)
+        if os.path.isabs(target) or target.split(os.sep)[0] in ('.', '..'):
+            return flask.Response(response='Invalid target model', status=400, mimetype='text/plain')
+        if not ScoringService.has_model(os.path.join(model_path, target)):
+            return flask.Response(response='Model {} not found'.format(target), status=404, mimetype='text/plain')
+    elif multi_model and not ScoringService.has_model(model_path):
+        return flask.Response(response='There is no default model, name one in the {} header'.format(TARGET_MODEL_HEADER),
+                              status=400, mimetype='text/plain')
+
+    if stream_chunk_rows > 0 and flask.request.mimetype == 'text/csv' and accept == 'text/csv':
+        return stream_transformation(target)
+
+    start = time.time()
+    body = flask.request.data
+    read = time.time()
+    stage_seconds['read'].observe(read - start)
+    try:
+        data = decoder(body)
+    except ValueError as e:
+        return flask.Response(response=str(e), status=400, mimetype='text/plain')
+    decoded = time.time()
+    stage_seconds['decode'].observe(decoded - read)
 
     print('Invoked with {} records'.format(data.shape[0]))
+    request_rows.observe(data.shape[0])
 
-    # Drop first column, since sample notebook uses training data to show case predictions
-    data.drop(data.columns[[0]],axis=1,inplace=True)
+    # Do the prediction, together with other requests in this worker if micro-batching is enabled
+    if batcher is not None:
+        predictions = batcher.predict(data, target)
+    else:
+        predictions = ScoringService.predict(data, target)
+    predicted = time.time()
+    stage_seconds['predict'].observe(predicted - decoded)
+
+    # Convert from numpy to the requested response format
+    with output_buffer() as out:
+        encoders[accept](predictions, out)
+        result = out.getvalue()
+    encoded = time.time()
+    stage_seconds['encode'].observe(encoded - predicted)
+    request_seconds.observe(encoded - start)
 
-    # Do the prediction
-    predictions = ScoringService.predict(data)
+    return flask.Response(response=result, status=200, mimetype=accept)
 
-    # Convert from numpy back to CSV
-    out = StringIO.StringIO()
-    pd.DataFrame({'results':predictions}).to_csv(out, header=False, index=False)
-    result = out.getvalue()
+def stream_transformation(target):
+    """Answer a CSV request chunk by chunk, with a chunked response that is sent while the rest of the
+    request body is still being read. Only the first chunk is predicted before the response starts, so
+    invalid input there still gets a 400; an error in a later chunk can only abort the response, which the
+    client sees as a truncated chunked body rather than a short but valid one."""
+    results = predict_csv_chunks(read_csv_chunks(flask.request.stream, stream_chunk_rows), target)
+    try:
+        first = next(results, None)
+    except ValueError as e:
+        return flask.Response(response=str(e), status=400, mimetype='text/plain')
+    if first is None:
+        return flask.Response(response='Empty CSV payload', status=400, mimetype='text/plain')
 
-    return flask.Response(response=result, status=200, mimetype='text/csv')
+    # X-Accel-Buffering tells nginx to pass each chunk on as it arrives rather than buffering the response
+    return flask.Response(response=flask.stream_with_context(itertools.chain([first], results)), status=200,
+                          mimetype='text/csv', headers={'X-Accel-Buffering': 'no'})
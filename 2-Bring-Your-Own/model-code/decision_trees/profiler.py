@@ -0,0 +1,97 @@
+# Profiling of the training job. train wraps each of its stages (loading the data, fitting, saving the model)
+# in TrainingProfile.stage, which records the wall time and the peak memory of the stage. At the end the
+# profile is written as JSON next to the job's other output and printed as metric lines that SageMaker can
+# pick up with the training job's MetricDefinitions, so the time of every stage can be followed in
+# CloudWatch across jobs and instance types.
+#
+# Linux only keeps the peak resident set size of a process since it started, which would make every stage
+# report the peak of the stages before it. Writing 5 to /proc/self/clear_refs resets that peak, so each stage
+# starts from its own baseline. Where that is not possible the peak since the start of the process is reported.
+
+from __future__ import print_function
+
+import json
+import resource
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+def _status_kb(field):
+    """Return a field of /proc/self/status in kB, or None if it is not available."""
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except (IOError, OSError):
+        pass
+    return None
+
+def reset_peak_rss():
+    """Reset the peak resident set size of this process to its current size. Returns False if it can't."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB, since the last reset_peak_rss."""
+    kb = _status_kb('VmHWM')
+    if kb is None:
+        # ru_maxrss is in kB on Linux
+        kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return kb / 1024.0
+
+def children_peak_rss_mb():
+    """Peak resident set size in MB of the largest child process that has exited, such as the loader's pool."""
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.0
+
+
+class TrainingProfile(object):
+    """Wall time and peak memory of the stages of a training job, plus facts about the job such as the
+    shape of the dataset."""
+
+    def __init__(self):
+        self.start = time.time()
+        self.stages = OrderedDict()
+        self.info = OrderedDict()
+
+    @contextmanager
+    def stage(self, name):
+        """Time the code in the with block as the stage name. A stage that raises is recorded as failed."""
+        reset_peak_rss()
+        start = time.time()
+        status = 'failed'
+        try:
+            yield
+            status = 'ok'
+        finally:
+            self.stages[name] = OrderedDict([('seconds', round(time.time() - start, 6)),
+                                             ('peak_rss_mb', round(peak_rss_mb(), 1)),
+                                             ('status', status)])
+
+    def set(self, **info):
+        self.info.update(info)
+
+    def report(self):
+        return OrderedDict([('total_seconds', round(time.time() - self.start, 6)),
+                            ('stages', self.stages),
+                            ('children_peak_rss_mb', round(children_peak_rss_mb(), 1)),
+                            ('info', self.info)])
+
+    def write(self, path):
+        with open(path, 'w') as out:
+            json.dump(self.report(), out, indent=2)
+
+    def print_metrics(self):
+        """Print every stage's time and memory as a line for SageMaker's metric regexes, e.g.
+        'profile: fit_seconds=12.345;' is matched by 'profile: fit_seconds=([0-9.]+);'."""
+        report = self.report()
+        print('profile: total_seconds={:.3f};'.format(report['total_seconds']))
+        for name, stage in self.stages.items():
+            print('profile: {}_seconds={:.3f};'.format(name, stage['seconds']))
+            print('profile: {}_peak_rss_mb={:.1f};'.format(name, stage['peak_rss_mb']))
+        print('profile: children_peak_rss_mb={:.1f};'.format(report['children_peak_rss_mb']))
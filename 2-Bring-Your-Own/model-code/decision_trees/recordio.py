@@ -0,0 +1,178 @@
+# This file decodes SageMaker's application/x-recordio-protobuf format, which is what the SageMaker SDK
+# produces with sagemaker.amazon.common.write_numpy_to_dense_tensor. Only the part of the Record protobuf
+# message that carries dense tensors is implemented, so the container does not need the protobuf runtime.
+#
+# A payload is a sequence of RecordIO frames:
+#
+#   uint32 magic (0xced7230a) | uint32 length | Record message | padding to a multiple of 4 bytes
+#
+# and each Record stores its feature vector in the features map under the key "values":
+#
+#   Record.features (1) -> map entry { key (1): "values", value (2): Value }
+#   Value.float32_tensor (2) / float64_tensor (3) / int32_tensor (7) -> Tensor
+#   Tensor.values (1, packed), Tensor.keys (2, only set for sparse tensors), Tensor.shape (3)
+
+import struct
+
+import numpy as np
+
+MAGIC = 0xced7230a
+
+_frame_header = struct.Struct('<II')
+_uint8 = struct.Struct('<B')
+
+# Value field number -> dtype of the packed tensor values. int32 tensors are varint encoded.
+_tensor_dtypes = {
+    2: np.dtype('<f4'),
+    3: np.dtype('<f8'),
+    7: np.dtype('<i4'),
+}
+
+def _read_varint(buf, pos):
+    result = 0
+    shift = 0
+    while True:
+        byte = _uint8.unpack_from(buf, pos)[0]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+def _fields(buf, start, end):
+    """Yield (field number, start, end) for every length-delimited field of the message in buf[start:end].
+    Scalar fields are skipped, since the messages decoded here only need strings, messages and packed arrays."""
+    pos = start
+    while pos < end:
+        key, pos = _read_varint(buf, pos)
+        number, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            _, pos = _read_varint(buf, pos)
+        elif wire_type == 1:
+            pos += 8
+        elif wire_type == 2:
+            length, pos = _read_varint(buf, pos)
+            yield number, pos, pos + length
+            pos += length
+        elif wire_type == 5:
+            pos += 4
+        else:
+            raise ValueError('Unsupported protobuf wire type {}'.format(wire_type))
+
+def _tensor_values(buf, start, end):
+    """Return the (start, end) of the packed values of the Tensor message in buf[start:end]."""
+    values = None
+    for number, field_start, field_end in _fields(buf, start, end):
+        if number == 1:
+            values = (field_start, field_end)
+        elif number == 2 and field_end > field_start:
+            raise ValueError('Sparse tensors are not supported')
+    return values
+
+def _decode_tensor(buf, dtype, values):
+    if values is None:
+        return np.empty(0, dtype=dtype)
+    field_start, field_end = values
+    if dtype.kind == 'f':
+        # Packed floats are stored little-endian back to back, so they can be viewed in place
+        return np.frombuffer(buf, dtype=dtype, count=(field_end - field_start) // dtype.itemsize, offset=field_start)
+    ints = []
+    pos = field_start
+    while pos < field_end:
+        value, pos = _read_varint(buf, pos)
+        ints.append(value - (1 << 64) if value >= (1 << 63) else value)
+    return np.array(ints, dtype=dtype)
+
+def _record_values(buf, start, end):
+    """Return (dtype, values) for the "values" feature of the Record message in buf[start:end], where values
+    is the (start, end) of its packed tensor values or None for an empty tensor."""
+    for number, entry_start, entry_end in _fields(buf, start, end):
+        if number != 1:
+            continue
+        key = value = None
+        for entry_number, field_start, field_end in _fields(buf, entry_start, entry_end):
+            if entry_number == 1:
+                key = buf[field_start:field_end]
+            elif entry_number == 2:
+                value = (field_start, field_end)
+        if key != b'values' or value is None:
+            continue
+        for value_number, tensor_start, tensor_end in _fields(buf, value[0], value[1]):
+            if value_number in _tensor_dtypes:
+                return _tensor_dtypes[value_number], _tensor_values(buf, tensor_start, tensor_end)
+        raise ValueError('The "values" feature is not a float32, float64 or int32 tensor')
+    raise ValueError('Record has no "values" feature')
+
+def _decode_uniform(body):
+    """Decode payloads where every frame has the same size and differs only in its float values, which is
+    what the SageMaker SDK writes for a dense matrix. The first record is parsed, the other frames are checked
+    byte for byte against it outside of the values, and the result is a strided read-only view over the
+    request body. Returns None when the payload does not have this layout."""
+    if len(body) < _frame_header.size:
+        return None
+    magic, length = _frame_header.unpack_from(body, 0)
+    length &= (1 << 29) - 1
+    frame_size = _frame_header.size + length + (-length % 4)
+    if magic != MAGIC or len(body) % frame_size:
+        return None
+    dtype, values = _record_values(body, _frame_header.size, _frame_header.size + length)
+    if dtype.kind != 'f' or values is None:
+        return None
+    frames = np.frombuffer(body, dtype=np.uint8).reshape(-1, frame_size)
+    if len(frames) > 1:
+        layout = np.ones(frame_size, dtype=bool)
+        layout[values[0]:values[1]] = False
+        if not (frames[1:, layout] == frames[0, layout]).all():
+            return None
+    return np.ndarray(shape=(len(frames), (values[1] - values[0]) // dtype.itemsize), dtype=dtype,
+                      buffer=body, offset=values[0], strides=(frame_size, dtype.itemsize))
+
+def decode(body):
+    """Decode a RecordIO-protobuf payload of dense tensors into a 2-D array with one row per record."""
+    try:
+        data = _decode_uniform(body)
+    except struct.error:
+        data = None
+    if data is not None:
+        return data
+    rows = []
+    pos = 0
+    try:
+        while pos < len(body):
+            magic, length = _frame_header.unpack_from(body, pos)
+            if magic != MAGIC:
+                raise ValueError('Invalid RecordIO magic number at offset {}'.format(pos))
+            # The top three bits are the continuation flag, which SageMaker never sets
+            length &= (1 << 29) - 1
+            pos += _frame_header.size
+            rows.append(_decode_tensor(body, *_record_values(body, pos, pos + length)))
+            pos += length + (-length % 4)
+    except struct.error:
+        raise ValueError('Truncated RecordIO payload')
+    if not rows:
+        raise ValueError('Empty RecordIO payload')
+    return np.vstack(rows)
+
+def _varint(value):
+    out = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if not value:
+            out.append(byte)
+            return bytes(out)
+        out.append(byte | 0x80)
+
+def _field(number, payload):
+    return _varint(number << 3 | 2) + _varint(len(payload)) + payload
+
+def encode(array):
+    """Encode a 2-D array as dense float32 records. This is the inverse of decode and is meant for clients
+    and benchmarks that do not have the SageMaker SDK installed."""
+    array = np.asarray(array, dtype='<f4')
+    frames = []
+    for row in array.reshape(array.shape[0], -1):
+        value = _field(2, _field(1, row.tobytes()))
+        record = _field(1, _field(1, b'values') + _field(2, value))
+        frames.append(_frame_header.pack(MAGIC, len(record)) + record + b'\0' * (-len(record) % 4))
+    return b''.join(frames)
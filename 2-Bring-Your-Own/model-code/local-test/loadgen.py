@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+
+# Load generator for the inference server. It replays synthetic requests against /invocations from a
+# number of concurrent clients and reports requests/s, rows/s and latency percentiles for every combination
+# of content type, batch size and server configuration.
+#
+# The server can be:
+#
+#   --url http://localhost:8080        a server that is already running, e.g. started with serve-local.sh
+#   --serve /opt/program/serve         serve, started (and stopped) by loadgen for every --configs entry.
+#                                      serve needs nginx and the /opt/program layout, so run this inside the
+#                                      container, e.g. docker run --entrypoint python <image> loadgen.py ...
+#   --in-process                       the Flask app called in this process, without nginx or gunicorn
+#
+# Usage:
+#
+#   python loadgen.py --url http://localhost:8080 --rows 1,100 --concurrency 8 --output results.json
+#   python loadgen.py --serve /opt/program/serve --configs 4:sync,4:gevent,2:gthread:4 --seconds 10
+#
+# --configs entries are workers:worker_class[:threads], passed to serve as MODEL_SERVER_WORKERS,
+# MODEL_SERVER_WORKER_CLASS and MODEL_SERVER_THREADS. The clients are Python threads, so with many workers
+# make sure loadgen itself is not the bottleneck, or run several copies.
+#
+# With --output, the results are written as JSON with the options used, so that runs against different
+# container builds can be compared.
+
+from __future__ import print_function
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+
+try:
+    import httplib
+    from urlparse import urlparse
+except ImportError:
+    import http.client as httplib
+    from urllib.parse import urlparse
+
+from payloads import make_rows, payload_builders
+
+
+class HttpClient(object):
+    """Posts to /invocations over one keep-alive connection."""
+
+    def __init__(self, url):
+        parsed = urlparse(url)
+        self.host, self.port = parsed.hostname, parsed.port or 80
+        self.connection = None
+
+    def post(self, body, content_type):
+        if self.connection is None:
+            self.connection = httplib.HTTPConnection(self.host, self.port, timeout=60)
+        try:
+            self.connection.request('POST', '/invocations', body, {'Content-Type': content_type})
+            response = self.connection.getresponse()
+            response.read()
+            return response.status
+        except (httplib.HTTPException, IOError):
+            self.connection.close()
+            self.connection = None
+            return None
+
+class InProcessClient(object):
+    """Calls the Flask app directly."""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def post(self, body, content_type):
+        return self.client.post('/invocations', data=body, content_type=content_type).status_code
+
+def run_load(make_client, body, content_type, concurrency, seconds):
+    """Post body from concurrency clients for the given number of seconds. Returns the latency of every
+    successful request in seconds, the number of failed requests and the elapsed time."""
+    latencies = []
+    failures = [0]
+    lock = threading.Lock()
+    deadline = time.time() + seconds
+
+    def run():
+        client = make_client()
+        ok = []
+        failed = 0
+        while time.time() < deadline:
+            start = time.time()
+            status = client.post(body, content_type)
+            if status == 200:
+                ok.append(time.time() - start)
+            else:
+                failed += 1
+        with lock:
+            latencies.extend(ok)
+            failures[0] += failed
+
+    start = time.time()
+    clients = [threading.Thread(target=run) for _ in range(concurrency)]
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    return latencies, failures[0], time.time() - start
+
+def summarize(latencies, failures, elapsed, rows):
+    latencies = sorted(latencies)
+
+    def percentile(p):
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1e3
+
+    return {
+        'requests': len(latencies),
+        'failures': failures,
+        'requests_per_second': len(latencies) / elapsed,
+        'rows_per_second': len(latencies) * rows / elapsed,
+        'p50_ms': percentile(0.50),
+        'p95_ms': percentile(0.95),
+        'p99_ms': percentile(0.99),
+    }
+
+def wait_for_ping(url, timeout):
+    parsed = urlparse(url)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            connection = httplib.HTTPConnection(parsed.hostname, parsed.port or 80, timeout=5)
+            connection.request('GET', '/ping')
+            if connection.getresponse().status == 200:
+                return
+        except (httplib.HTTPException, IOError):
+            pass
+        time.sleep(0.5)
+    raise RuntimeError('The server did not answer /ping within {} seconds'.format(timeout))
+
+def parse_config(config):
+    """Parse a workers:worker_class[:threads] --configs entry."""
+    parts = config.split(':')
+    return {'workers': int(parts[0]), 'worker_class': parts[1], 'threads': int(parts[2]) if len(parts) > 2 else 1}
+
+def start_serve(serve, config, url):
+    env = dict(os.environ, MODEL_SERVER_WORKERS=str(config['workers']),
+               MODEL_SERVER_WORKER_CLASS=config['worker_class'], MODEL_SERVER_THREADS=str(config['threads']))
+    server = subprocess.Popen([sys.executable, serve], cwd=os.path.dirname(os.path.abspath(serve)), env=env)
+    try:
+        wait_for_ping(url, 120)
+    except Exception:
+        server.terminate()
+        server.wait()
+        raise
+    return server
+
+def in_process_app(args):
+    """Import the Flask app, with the model in --model-dir or a tree trained on synthetic data."""
+    import predictor
+    if args.model_dir:
+        predictor.model_path = args.model_dir
+    else:
+        from sklearn import tree
+        data = make_rows(1000, args.columns)
+        predictor.ScoringService.model = tree.DecisionTreeClassifier().fit(data[:, 1:], data[:, 0])
+    return predictor.app
+
+def run_suite(args, make_client, config, out=sys.stdout):
+    results = []
+    for content_type in args.content_types:
+        for rows in args.rows:
+            body = payload_builders[content_type](make_rows(rows, args.columns))
+            # Warm up, so model loading and first-request costs are not measured
+            run_load(make_client, body, content_type, args.concurrency, min(1.0, args.seconds))
+            latencies, failures, elapsed = run_load(make_client, body, content_type, args.concurrency, args.seconds)
+            result = dict(config, content_type=content_type, rows=rows, concurrency=args.concurrency)
+            result.update(summarize(latencies, failures, elapsed, rows))
+            results.append(result)
+            print('{:<20} {:<32} {:>7} {:>10.1f} {:>12.0f} {:>9} {:>9} {:>9} {:>8}'.format(
+                config['name'], content_type, rows, result['requests_per_second'], result['rows_per_second'],
+                format_ms(result['p50_ms']), format_ms(result['p95_ms']), format_ms(result['p99_ms']), failures), file=out)
+    return results
+
+def format_ms(value):
+    return '-' if value is None else '{:.2f}'.format(value)
+
+def main():
+    parser = argparse.ArgumentParser(description='Load generator for the decision tree inference server.')
+    server = parser.add_mutually_exclusive_group(required=True)
+    server.add_argument('--url', help='base URL of a running server')
+    server.add_argument('--serve', help='path of the serve program to start for every --configs entry')
+    server.add_argument('--in-process', action='store_true', help='call the Flask app in this process')
+    parser.add_argument('--configs', default='{}:gevent'.format(multiprocessing.cpu_count()),
+                        type=lambda s: [parse_config(c) for c in s.split(',')],
+                        help='comma separated workers:worker_class[:threads] server configurations for --serve')
+    parser.add_argument('--port', type=int, default=8080, help='port that serve listens on')
+    parser.add_argument('--model-dir', help='model directory for --in-process, a synthetic tree is trained if omitted')
+    parser.add_argument('--content-types', default='text/csv', type=lambda s: s.split(','),
+                        help='comma separated request content types, of {}'.format(', '.join(sorted(payload_builders))))
+    parser.add_argument('--rows', default='1,10,100,1000', type=lambda s: [int(r) for r in s.split(',')],
+                        help='comma separated numbers of rows per request')
+    parser.add_argument('--columns', type=int, default=4, help='number of feature columns')
+    parser.add_argument('--concurrency', type=int, default=8, help='number of concurrent clients')
+    parser.add_argument('--seconds', type=float, default=5, help='length of each measurement')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    args = parser.parse_args()
+    for content_type in args.content_types:
+        if content_type not in payload_builders:
+            parser.error('unsupported content type {}'.format(content_type))
+
+    print('{:<20} {:<32} {:>7} {:>10} {:>12} {:>9} {:>9} {:>9} {:>8}'.format(
+        'server', 'content type', 'rows', 'req/s', 'rows/s', 'p50 ms', 'p95 ms', 'p99 ms', 'failed'))
+    results = []
+    if args.url:
+        results += run_suite(args, lambda: HttpClient(args.url), {'name': 'url'})
+    elif args.in_process:
+        app = in_process_app(args)
+        # Keep the app's per-request log lines out of the report
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            results += run_suite(args, lambda: InProcessClient(app), {'name': 'in-process'}, stdout)
+        finally:
+            sys.stdout = stdout
+    else:
+        url = 'http://localhost:{}'.format(args.port)
+        for config in args.configs:
+            config['name'] = '{workers}:{worker_class}:{threads}'.format(**config)
+            server = start_serve(args.serve, config, url)
+            try:
+                results += run_suite(args, lambda: HttpClient(url), config)
+            finally:
+                server.terminate()
+                server.wait()
+
+    if args.output:
+        with open(args.output, 'w') as out:
+            json.dump({'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                       'host': platform.node(),
+                       'python': platform.python_version(),
+                       'options': {'rows': args.rows, 'columns': args.columns, 'concurrency': args.concurrency,
+                                   'seconds': args.seconds, 'content_types': args.content_types},
+                       'results': results}, out, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+
+# Microbenchmarks for the request hot paths in decision_trees/predictor.py. The functions are called
+# in-process, without nginx or gunicorn, and the per-call latency is printed for a range of batch
+# sizes. This makes it easy to see where fixed per-request overhead dominates.
+#
+# Usage:
+#
+#   python microbench.py <benchmark> [--rows 1,10,100,1000,10000] [--columns 4] [--repeat 200] [--gevent]
+#
+# Benchmarks:
+#
+#   decode      text/csv request decoding with each of the MODEL_SERVER_CSV_DECODER choices
+#   encode      response encoding for each supported Accept type, against a pandas to_csv baseline
+#   formats     request decoding throughput for every registered content type, against the CSV path
+#   load        model load time and memory for pickled vs. memory-mapped trees of --nodes sizes
+#   engine      prediction latency of the sklearn, flat and auto engines, after checking they agree exactly
+#   stream      peak memory of /invocations for CSV payloads of --rows sizes, read whole vs. streamed in chunks
+#   reload      time to hot reload a replaced tree fit on the first of --nodes rows and /invocations latency
+#               before, during and after the swap, from threads or with --gevent greenlets as in a gevent worker
+
+from __future__ import print_function
+
+import sys
+
+# Like gunicorn's gevent workers, --gevent has to patch the standard library before anything else imports it
+if '--gevent' in sys.argv:
+    from gevent import monkey
+    monkey.patch_all()
+
+import argparse
+import io
+import multiprocessing
+import os
+import pickle
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import timeit
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'decision_trees'))
+
+import predictor
+from flat_tree import FlatTree
+from payloads import make_csv, make_rows, payload_builders
+
+
+def time_call(fn, repeat):
+    """Call fn repeatedly and return the (p50, p99) latency in microseconds."""
+    times = sorted(timeit.repeat(fn, repeat=repeat, number=1))
+    p50 = times[len(times) // 2]
+    p99 = times[min(len(times) - 1, int(len(times) * 0.99))]
+    return p50 * 1e6, p99 * 1e6
+
+def print_header(*columns):
+    print('{:<12} {:>8} {:>12} {:>12}'.format(*columns))
+
+def print_result(name, rows, latency):
+    print('{:<12} {:>8} {:>12.1f} {:>12.1f}'.format(name, rows, latency[0], latency[1]))
+
+# Bodies that the numpy decoder must reject, as pandas would with an error or NaNs. The ragged ones have as
+# many values as a full matrix, so only a per-row column check catches them.
+invalid_csv = {
+    'ragged': b'1,2,3\n4,5,6,7\n8,9',
+    'ragged-first-row': b'1,2,3,4\n5,6\n7,8,9,10',
+    'non-numeric': b'1,2,3\n4,x,6',
+    'empty': b'\n',
+}
+
+def check_decoders(columns):
+    """Check that the CSV decoders agree on a valid body and that the numpy decoder rejects invalid ones."""
+    body = make_csv(100, columns)
+    expected = np.asarray(predictor.decode_csv_pandas(body), dtype=np.float64)
+    for name, decoder in sorted(predictor.csv_decoders.items()):
+        # pandas' default float parser can be off in the last digit, so not exactly equal
+        if not np.allclose(np.asarray(decoder(body), dtype=np.float64), expected, rtol=1e-12, atol=0):
+            raise AssertionError('The {} decoder disagrees with pandas'.format(name))
+    for case, invalid in sorted(invalid_csv.items()):
+        try:
+            predictor.decode_csv_numpy(invalid)
+        except ValueError:
+            continue
+        raise AssertionError('The numpy decoder accepted the {} body {!r}'.format(case, invalid))
+
+def bench_decode(args):
+    check_decoders(args.columns)
+    print_header('decoder', 'rows', 'p50 us', 'p99 us')
+    for rows in args.rows:
+        body = make_csv(rows, args.columns)
+        for name, decoder in sorted(predictor.csv_decoders.items()):
+            print_result(name, rows, time_call(lambda: decoder(body), args.repeat))
+
+def encode_pandas(predictions, buf):
+    """The original response path: a one column dataframe written with to_csv."""
+    out = io.StringIO() if sys.version_info[0] >= 3 else io.BytesIO()
+    pd.DataFrame({'results': predictions}).to_csv(out, header=False, index=False)
+    buf.write(out.getvalue().encode('utf-8') if sys.version_info[0] >= 3 else out.getvalue())
+
+def bench_encode(args):
+    encoders = [('pandas', encode_pandas)] + list(predictor.encoders.items())
+    print_header('encoder', 'rows', 'p50 us', 'p99 us')
+    for rows in args.rows:
+        predictions = make_rows(rows, args.columns)[:, 1]
+        for name, encoder in encoders:
+            def encode():
+                with predictor.output_buffer() as buf:
+                    encoder(predictions, buf)
+                    return buf.getvalue()
+            print_result(name.split('/')[-1], rows, time_call(encode, args.repeat))
+
+def bench_formats(args):
+    print_header('format', 'rows', 'p50 us', 'p99 us')
+    for rows in args.rows:
+        data = make_rows(rows, args.columns)
+        for content_type, decoder in sorted(predictor.decoders.items()):
+            body = payload_builders[content_type](data)
+            print_result(content_type.split('/')[-1][:12], rows, time_call(lambda: decoder(body), args.repeat))
+
+def rss_kb():
+    """Return (private, total) resident memory of this process in KB. Private memory is what every gunicorn
+    worker pays for separately, file-backed pages such as memory-mapped models are shared between them."""
+    fields = {}
+    with open('/proc/self/status') as status:
+        for line in status:
+            name, _, value = line.partition(':')
+            fields[name] = value.split()[0] if value.split() else '0'
+    total = int(fields['VmRSS'])
+    return int(fields.get('RssAnon', total)), total
+
+def measure_load(load, features, queue):
+    """Load a model in this (forked) process, run one prediction and report the cost of doing so."""
+    private, total = rss_kb()
+    start = time.time()
+    model = load()
+    model.predict(features)
+    elapsed = time.time() - start
+    private_after, total_after = rss_kb()
+    queue.put((elapsed, private_after - private, total_after - total))
+
+def load_pickle(path):
+    with open(path, 'rb') as inp:
+        return pickle.load(inp)
+
+def bench_load(args):
+    from sklearn import tree
+    print('{:<12} {:>8} {:>12} {:>12} {:>12}'.format('format', 'nodes', 'load ms', 'private KB', 'rss KB'))
+    directory = tempfile.mkdtemp()
+    try:
+        for nodes in args.nodes:
+            data = make_rows(nodes, args.columns)
+            clf = tree.DecisionTreeClassifier(max_leaf_nodes=nodes // 2 + 1).fit(data[:, 1:], data[:, 0])
+            pickle_path = os.path.join(directory, 'model.pkl')
+            with open(pickle_path, 'wb') as out:
+                pickle.dump(clf, out)
+            bundle_path = os.path.join(directory, 'bundle')
+            FlatTree.from_estimator(clf).save(bundle_path)
+            features = data[:1000, 1:]
+            for name, load in [('pickle', lambda: load_pickle(pickle_path)), ('mmap', lambda: FlatTree.load(bundle_path))]:
+                queue = multiprocessing.Queue()
+                process = multiprocessing.Process(target=measure_load, args=(load, features, queue))
+                process.start()
+                elapsed, private, total = queue.get()
+                process.join()
+                print('{:<12} {:>8} {:>12.1f} {:>12} {:>12}'.format(name, clf.tree_.node_count, elapsed * 1e3, private, total))
+    finally:
+        shutil.rmtree(directory)
+
+def bench_engine(args):
+    from sklearn import tree
+    data = make_rows(max(args.nodes[0], 2), args.columns)
+    clf = tree.DecisionTreeClassifier().fit(data[:, 1:], data[:, 0])
+    flat = predictor.ScoringService.export_flat(clf)
+    auto = predictor.AutoEngine(clf, flat)
+    print('tree with {} nodes and depth {}'.format(flat.node_count, clf.tree_.max_depth))
+    print_header('engine', 'rows', 'p50 us', 'p99 us')
+    for rows in args.rows:
+        features = make_rows(rows, args.columns, seed=1)[:, 1:]
+        if not np.array_equal(clf.predict(features), flat.predict(features)):
+            raise AssertionError('The flat engine disagrees with scikit-learn on {} rows'.format(rows))
+        print_result('sklearn', rows, time_call(lambda: clf.predict(features), args.repeat))
+        print_result('flat', rows, time_call(lambda: flat.predict(features), args.repeat))
+        print_result('auto', rows, time_call(lambda: auto.predict(features), args.repeat))
+
+def measure_invocation(clf, path, chunk_rows, queue):
+    """Post the CSV payload in path to the app from this (forked) process, reading the response piece by
+    piece, and report the time taken and how far the request raised the process's peak RSS."""
+    sys.stdout = open(os.devnull, 'w')
+    predictor.ScoringService.model = clf
+    predictor.stream_chunk_rows = chunk_rows
+    client = predictor.app.test_client()
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    with open(path, 'rb') as body:
+        response = client.post('/invocations', input_stream=body, content_type='text/csv',
+                               content_length=os.path.getsize(path), buffered=False)
+        for _ in response.response:
+            pass
+        response.close()
+    elapsed = time.time() - start
+    queue.put((response.status_code, elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline))
+
+def bench_stream(args):
+    from sklearn import tree
+    data = make_rows(1000, args.columns)
+    clf = tree.DecisionTreeClassifier().fit(data[:, 1:], data[:, 0])
+    chunk_rows = 10000
+    print('{:<12} {:>8} {:>12} {:>12} {:>14}'.format('mode', 'rows', 'payload KB', 'seconds', 'peak RSS +KB'))
+    directory = tempfile.mkdtemp()
+    try:
+        for rows in args.rows:
+            path = os.path.join(directory, 'payload.csv')
+            with open(path, 'wb') as out:
+                for start in range(0, rows, chunk_rows):
+                    out.write(make_csv(min(chunk_rows, rows - start), args.columns, seed=start))
+            for name, chunks in [('whole', 0), ('streamed', chunk_rows)]:
+                queue = multiprocessing.Queue()
+                process = multiprocessing.Process(target=measure_invocation, args=(clf, path, chunks, queue))
+                process.start()
+                status, elapsed, peak = queue.get()
+                process.join()
+                if status != 200:
+                    raise AssertionError('/invocations returned {} in {} mode'.format(status, name))
+                print('{:<12} {:>8} {:>12} {:>12.2f} {:>14}'.format(name, rows, os.path.getsize(path) // 1024, elapsed, peak))
+    finally:
+        shutil.rmtree(directory)
+
+def write_model(clf, directory):
+    """Replace the pickled model in directory atomically, the way a model update should be deployed."""
+    temp_path = os.path.join(directory, 'decision-tree-model.pkl.tmp')
+    with open(temp_path, 'wb') as out:
+        pickle.dump(clf, out)
+    os.rename(temp_path, os.path.join(directory, 'decision-tree-model.pkl'))
+
+def percentiles(latencies):
+    """Return the (p50, p99) of latencies in seconds, in microseconds."""
+    if not latencies:
+        return float('nan'), float('nan')
+    latencies = sorted(latencies)
+    return latencies[len(latencies) // 2] * 1e6, latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1e6
+
+def bench_reload(args, threads=4, seconds=1.0):
+    from sklearn import tree
+    data = make_rows(max(args.nodes[0], 2), args.columns)
+    # Two models with different labels, so every response tells which one answered it
+    old = tree.DecisionTreeClassifier().fit(data[:, 1:], np.where(data[:, 0] > 1, 'old-a', 'old-b'))
+    new = tree.DecisionTreeClassifier().fit(data[:, 1:], np.where(data[:, 0] > 1, 'new-a', 'new-b'))
+    directory = tempfile.mkdtemp()
+    saved = predictor.model_path, predictor.reload_interval, sys.stdout
+    try:
+        write_model(old, directory)
+        predictor.model_path, predictor.reload_interval = directory, 0.01
+        predictor.ScoringService.model = None
+        predictor.ScoringService.get_model()
+        sys.stdout = open(os.devnull, 'w')
+
+        body = make_csv(args.rows[0], args.columns)
+        results = []
+        deadline = time.time() + 3 * seconds
+
+        def run():
+            client = predictor.app.test_client()
+            while time.time() < deadline:
+                start = time.time()
+                response = client.post('/invocations', data=body, content_type='text/csv')
+                end = time.time()
+                results.append((start, end, response.status_code, response.data[:3] == b'new'))
+                # The test client never waits on a socket, so give the other clients a turn like a server would
+                time.sleep(0)
+
+        runners = [threading.Thread(target=run) for _ in range(threads)]
+        for runner in runners:
+            runner.start()
+        time.sleep(seconds)
+        swap_start = time.time()
+        write_model(new, directory)
+        for runner in runners:
+            runner.join()
+    finally:
+        sys.stdout = saved[2]
+        predictor.model_path, predictor.reload_interval = saved[:2]
+        shutil.rmtree(directory)
+
+    # The first response from the new model marks the end of the swap
+    swapped = min([end for _, end, _, is_new in results if is_new] or [float('nan')])
+    failed = sum(1 for _, _, status, _ in results if status != 200)
+    print('tree with {} nodes, {} requests of {} rows from {} {}, {} failed'.format(
+        new.tree_.node_count, len(results), args.rows[0], threads, 'greenlets' if args.gevent else 'threads', failed))
+    print('new model answered {:.1f} ms after the artifact was replaced'.format((swapped - swap_start) * 1e3))
+    # A load that blocks the worker shows up as one long request rather than in the percentiles
+    print('slowest request during the swap took {:.1f} ms'.format(
+        max([end - start for start, end, _, _ in results if end > swap_start and start < swapped] or [float('nan')]) * 1e3))
+    print_header('phase', 'requests', 'p50 us', 'p99 us')
+    for phase, low, high in [('before', 0, swap_start), ('during', swap_start, swapped), ('after', swapped, float('inf'))]:
+        latencies = [end - start for start, end, _, _ in results if low <= start < high]
+        print_result(phase, len(latencies), percentiles(latencies))
+
+benchmarks = {
+    'decode': bench_decode,
+    'encode': bench_encode,
+    'formats': bench_formats,
+    'load': bench_load,
+    'engine': bench_engine,
+    'stream': bench_stream,
+    'reload': bench_reload,
+}
+
+def main():
+    parser = argparse.ArgumentParser(description='Microbenchmarks for the decision tree inference server.')
+    parser.add_argument('benchmark', choices=sorted(benchmarks))
+    parser.add_argument('--rows', default='1,10,100,1000,10000',
+                        type=lambda s: [int(r) for r in s.split(',')],
+                        help='comma separated batch sizes to measure')
+    parser.add_argument('--nodes', default='10000,100000,1000000',
+                        type=lambda s: [int(n) for n in s.split(',')],
+                        help='comma separated tree sizes for the load benchmark, the first one is used by engine and reload')
+    parser.add_argument('--columns', type=int, default=4, help='number of feature columns')
+    parser.add_argument('--repeat', type=int, default=200, help='number of timed calls per measurement')
+    parser.add_argument('--gevent', action='store_true', help='run the reload clients as greenlets, as in a gevent worker')
+    args = parser.parse_args()
+    benchmarks[args.benchmark](args)
+
+if __name__ == '__main__':
+    main()
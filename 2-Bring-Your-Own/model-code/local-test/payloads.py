@@ -0,0 +1,58 @@
+# Synthetic data and request bodies shared by microbench.py and loadgen.py. This module does not import
+# predictor, so that loadgen can build requests for a server it does not run in-process.
+
+import io
+import os
+import sys
+
+import numpy as np
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'decision_trees'))
+
+import recordio
+
+
+def make_rows(rows, columns, seed=0):
+    """Build a float matrix with an integer class label in the first column, like the training data."""
+    rng = np.random.RandomState(seed)
+    data = rng.uniform(0, 10, size=(rows, columns + 1))
+    data[:, 0] = rng.randint(0, 3, size=rows)
+    return data
+
+def encode_csv(data):
+    """Write a matrix as CSV, with repr so that the floats round trip exactly."""
+    return ('\n'.join(','.join(repr(v) for v in row) for row in data.tolist()) + '\n').encode('utf-8')
+
+def make_csv(rows, columns, seed=0):
+    """Build a numeric CSV request body with a label in the first column."""
+    return encode_csv(make_rows(rows, columns, seed))
+
+def make_npy(features):
+    buf = io.BytesIO()
+    np.save(buf, features)
+    return buf.getvalue()
+
+def make_arrow(features):
+    batch = pa.RecordBatch.from_arrays([pa.array(column) for column in features.T],
+                                       ['f{}'.format(i) for i in range(features.shape[1])])
+    sink = pa.BufferOutputStream()
+    writer = pa.RecordBatchStreamWriter(sink, batch.schema)
+    writer.write_batch(batch)
+    writer.close()
+    return sink.getvalue().to_pybytes()
+
+# Builds a request body for each content type from a matrix whose first column is the label. CSV keeps the
+# label column, like the sample notebook does and the server drops, and the binary formats only carry the
+# features. Arrow is only available when pyarrow is installed, like on the server.
+payload_builders = {
+    'text/csv': encode_csv,
+    'application/x-npy': lambda data: make_npy(data[:, 1:]),
+    'application/x-recordio-protobuf': lambda data: recordio.encode(data[:, 1:]),
+}
+if pa is not None:
+    payload_builders['application/vnd.apache.arrow.stream'] = lambda data: make_arrow(data[:, 1:])
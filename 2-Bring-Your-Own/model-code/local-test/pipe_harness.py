@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+
+# Runs the train program against a simulated Pipe mode channel, without SageMaker or Docker. A temporary
+# directory is laid out like /opt/ml, with an inputdataconfig.json that puts the training channel in Pipe
+# mode and a training_0 FIFO that a writer thread fills with the CSV files of a data directory, the way
+# SageMaker streams the S3 objects of the channel one after the other.
+#
+# Usage:
+#
+#   python pipe_harness.py <data directory> [--throttle-mb 50] [--compare] [--hyperparameters '{...}']
+#
+# --throttle-mb limits the writer to that many MB/s, to see how training behaves with a slow stream.
+# --hyperparameters are passed to train. With training_mode=incremental, the writer streams the files again
+# for every epoch through training_1, training_2 and so on, like SageMaker does.
+# --compare also trains in File mode on the same files and checks that both models predict the same, or for
+# incremental training, how often they agree.
+# Note that SageMaker concatenates the objects as they are, so every file has to end with a newline.
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import pickle
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import types
+
+decision_trees = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'decision_trees')
+sys.path.insert(0, decision_trees)
+
+BLOCK_SIZE = 1 << 16
+
+
+def load_train(prefix):
+    """Load the train program as a module with its /opt/ml paths moved under prefix."""
+    path = os.path.join(decision_trees, 'train')
+    module = types.ModuleType('train')
+    module.__file__ = path
+    with open(path) as source:
+        exec(compile(source.read(), path, 'exec'), module.__dict__)
+    module.prefix = prefix
+    module.input_path = os.path.join(prefix, 'input/data')
+    module.output_path = os.path.join(prefix, 'output')
+    module.model_path = os.path.join(prefix, 'model')
+    module.param_path = os.path.join(prefix, 'input/config/hyperparameters.json')
+    module.input_config_path = os.path.join(prefix, 'input/config/inputdataconfig.json')
+    module.training_path = os.path.join(module.input_path, module.channel_name)
+    return module
+
+def make_prefix(mode, hyperparameters=None):
+    prefix = tempfile.mkdtemp()
+    for directory in ['input/config', 'input/data', 'model', 'output']:
+        os.makedirs(os.path.join(prefix, directory))
+    with open(os.path.join(prefix, 'input/config/hyperparameters.json'), 'w') as out:
+        json.dump(hyperparameters or {}, out)
+    with open(os.path.join(prefix, 'input/config/inputdataconfig.json'), 'w') as out:
+        json.dump({'training': {'TrainingInputMode': mode, 'ContentType': 'text/csv'}}, out)
+    return prefix
+
+def ends_with_newline(path):
+    with open(path, 'rb') as inp:
+        inp.seek(0, os.SEEK_END)
+        if inp.tell() == 0:
+            return True
+        inp.seek(-1, os.SEEK_END)
+        return inp.read(1) == b'\n'
+
+def feed_epochs(fifos, files, throttle):
+    """Feed the files through each of the FIFOs in turn, one per epoch."""
+    for fifo in fifos:
+        feed(fifo, files, throttle)
+
+def feed(fifo, files, throttle):
+    """Write the files into the FIFO one after the other, at most throttle bytes per second if given."""
+    start = time.time()
+    written = 0
+    with open(fifo, 'wb') as out:
+        for path in files:
+            with open(path, 'rb') as inp:
+                for block in iter(lambda: inp.read(BLOCK_SIZE), b''):
+                    out.write(block)
+                    written += len(block)
+                    if throttle:
+                        delay = start + float(written) / throttle - time.time()
+                        if delay > 0:
+                            time.sleep(delay)
+
+def run_train(module):
+    """Run train and return the elapsed time, raising if it failed."""
+    start = time.time()
+    try:
+        module.train()
+    except SystemExit as e:
+        with open(os.path.join(module.output_path, 'failure')) as failure:
+            raise RuntimeError('train exited with {}:\n{}'.format(e.code, failure.read()))
+    return time.time() - start
+
+def load_model(prefix):
+    with open(os.path.join(prefix, 'model', 'decision-tree-model.pkl'), 'rb') as inp:
+        return pickle.load(inp)
+
+def main():
+    parser = argparse.ArgumentParser(description='Run train against a local Pipe mode FIFO.')
+    parser.add_argument('data', help='directory of CSV training files')
+    parser.add_argument('--throttle-mb', type=float, default=0, help='limit the stream to this many MB/s')
+    parser.add_argument('--compare', action='store_true', help='also train in File mode and compare the models')
+    parser.add_argument('--hyperparameters', default={}, type=json.loads, help='hyperparameters as a JSON object')
+    args = parser.parse_args()
+    files = sorted(os.path.join(args.data, name) for name in os.listdir(args.data))
+    size = sum(os.path.getsize(path) for path in files)
+    unterminated = [path for path in files[:-1] if not ends_with_newline(path)]
+    if unterminated:
+        parser.error('these files do not end with a newline, so in Pipe mode their last line would run into the '
+                     'next file: {}'.format(', '.join(unterminated)))
+
+    hyperparameters = args.hyperparameters
+    epochs = 1
+    if hyperparameters.get('training_mode') == 'incremental':
+        # The first pass over the data only collects the classes and the feature scaling
+        epochs += int(hyperparameters.get('epochs', 5))
+    pipe_prefix = make_prefix('Pipe', hyperparameters)
+    file_prefix = None
+    try:
+        module = load_train(pipe_prefix)
+        fifos = ['{}_{}'.format(module.training_path, epoch) for epoch in range(epochs)]
+        for fifo in fifos:
+            os.mkfifo(fifo)
+        writer = threading.Thread(target=feed_epochs, args=(fifos, files, args.throttle_mb * 1024 * 1024))
+        # A daemon, so the harness still exits if train fails without ever opening the FIFO
+        writer.daemon = True
+        writer.start()
+        elapsed = run_train(module)
+        writer.join()
+        print('Pipe mode: trained on {} files ({:.1f} MB) in {:.2f} seconds'.format(len(files), size / 1048576.0, elapsed))
+
+        if args.compare:
+            file_prefix = make_prefix('File', hyperparameters)
+            module = load_train(file_prefix)
+            shutil.copytree(args.data, module.training_path)
+            elapsed = run_train(module)
+            print('File mode: trained in {:.2f} seconds, not counting the copy of the data'.format(elapsed))
+            from csv_loader import load_csv_files
+            _, features = load_csv_files(files)
+            same = load_model(pipe_prefix).predict(features) == load_model(file_prefix).predict(features)
+            if epochs > 1:
+                # The chunks, and so the order of the updates, differ between the modes
+                print('The models agree on {:.1%} of the records.'.format(same.mean()))
+            elif not same.all():
+                raise AssertionError('The Pipe and File mode models predict differently')
+            else:
+                print('Both models predict the same.')
+    finally:
+        shutil.rmtree(pipe_prefix)
+        if file_prefix is not None:
+            shutil.rmtree(file_prefix)
+
+if __name__ == '__main__':
+    main()